@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+"""
+Batch image filtering
+- Applies a filter chain to every image matching the given globs, spread
+  across a pool of worker processes
+
+Invoked as, for example:
+   python batch.py "scans/*.png" --filter blur:7 --output out/ --workers 8
+   python batch.py "frames/*.png" --filter invert,edges --output edges/
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import lab
+import pipeline
+import streaming
+
+# Filters that take a kernel size
+SIZED_FILTERS = ('blur', 'sharpen', 'median')
+FILTERS = ('invert', 'edges') + SIZED_FILTERS
+
+
+def parse_filter_spec(spec):
+    """
+    Parses a filter chain such as "invert,blur:7,edges" into a list of
+    (name, kernel_size) stages; kernel_size is None for unsized filters.
+    """
+    stages = []
+    for part in spec.split(','):
+        name, _, size = part.strip().partition(':')
+        if name not in FILTERS:
+            raise ValueError(f"Unknown filter: {name!r}")
+        if name in SIZED_FILTERS:
+            if not size.isdigit() or int(size) < 1:
+                raise ValueError(f"{name} needs a positive kernel size, e.g. {name}:3")
+            stages.append((name, int(size)))
+        elif size:
+            raise ValueError(f"{name} does not take a kernel size")
+        else:
+            stages.append((name, None))
+    return stages
+
+
+def apply_stages(image, stages):
+    """
+    Runs a parsed filter chain on an image as one fused pipeline.
+    """
+    node = pipeline.Pipeline(image)
+    for name, size in stages:
+        if name == 'invert':
+            node = node.inverted()
+        elif name == 'edges':
+            node = node.edges()
+        elif name == 'blur':
+            node = node.blurred(size)
+        elif name == 'median':
+            node = node.median_filtered(size)
+        else:
+            node = node.sharpened(size)
+    return node.compute()
+
+
+def process_file(in_filename, out_filename, stages, stream=False):
+    """
+    Worker job: decodes, filters and encodes one file. Returns
+    (in_filename, pixels, decode seconds, compute seconds, encode seconds);
+    with stream=True the three stages overlap and are reported as compute.
+    """
+    start = time.perf_counter()
+    if stream:
+        height, width, rows = streaming.open_rows(in_filename)
+        for name, size in stages:
+            rows = lab.filter_rows(rows, height, width, name, size)
+        streaming.write_png_rows(out_filename, width, height, rows)
+        return in_filename, height * width, 0.0, time.perf_counter() - start, 0.0
+
+    image = lab.load_greyscale_image(in_filename)
+    decoded = time.perf_counter()
+    result = apply_stages(image, stages)
+    computed = time.perf_counter()
+    lab.save_greyscale_image(result, out_filename)
+    return (in_filename, image['height'] * image['width'],
+            decoded - start, computed - decoded, time.perf_counter() - computed)
+
+
+def find_inputs(patterns):
+    """
+    Expands the input globs into a sorted list of distinct files.
+    """
+    files = set()
+    for pattern in patterns:
+        files.update(path for path in glob.glob(pattern, recursive=True)
+                     if os.path.isfile(path))
+    return sorted(files)
+
+
+def output_names(inputs, output_dir):
+    """
+    Returns the output filename of each input: a PNG of the same name in
+    output_dir, under the input's directory relative to the directory all
+    inputs share, so "a/x.png" and "b/x.png" do not collide. Raises
+    ValueError if two inputs would still be written to the same file, such
+    as "x.png" and "x.jpg".
+    """
+    directories = [os.path.dirname(os.path.abspath(name)) for name in inputs]
+    common = os.path.commonpath(directories) if directories else ''
+    outputs = {}
+    for in_filename, directory in zip(inputs, directories):
+        stem = os.path.splitext(os.path.basename(in_filename))[0] + '.png'
+        relative = os.path.relpath(directory, common)
+        out_filename = os.path.normpath(os.path.join(output_dir, relative, stem))
+        if out_filename in outputs:
+            raise ValueError(f"{outputs[out_filename]} and {in_filename} would both be "
+                             f"written to {out_filename}")
+        outputs[out_filename] = in_filename
+    return list(outputs)
+
+
+def is_up_to_date(in_filename, out_filename):
+    return (os.path.exists(out_filename)
+            and os.path.getmtime(out_filename) >= os.path.getmtime(in_filename))
+
+
+def run_batch(inputs, output_dir, stages, workers=None, force=False, stream=False,
+              report=print):
+    """
+    Filters every input file into output_dir using a pool of worker
+    processes and returns a summary dict.
+
+    At most 2 * workers files are in flight at once, so each worker always
+    has its next file queued: one worker decodes or encodes while the others
+    compute. Outputs newer than their inputs are skipped unless force is set.
+    Outputs are named by output_names, which raises ValueError before any
+    work starts if two inputs would overwrite each other.
+    """
+    workers = workers or os.cpu_count() or 1
+    jobs = []
+    skipped = 0
+    for in_filename, out_filename in zip(inputs, output_names(inputs, output_dir)):
+        if not force and is_up_to_date(in_filename, out_filename):
+            skipped += 1
+            continue
+        os.makedirs(os.path.dirname(out_filename), exist_ok=True)
+        jobs.append((in_filename, out_filename))
+
+    summary = {'processed': 0, 'skipped': skipped, 'failed': 0, 'pixels': 0}
+    start = time.perf_counter()
+    pending = set()
+    names = {}
+    queue = iter(jobs)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            for in_filename, out_filename in queue:
+                future = pool.submit(process_file, in_filename, out_filename, stages,
+                                     stream)
+                names[future] = in_filename
+                pending.add(future)
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    name, pixels, decode, compute, encode = future.result()
+                except (OSError, ValueError) as error:
+                    summary['failed'] += 1
+                    report(f"{names.pop(future)}: FAILED ({error})")
+                    continue
+                del names[future]
+                summary['processed'] += 1
+                summary['pixels'] += pixels
+                total = decode + compute + encode
+                report(f"{name}: {pixels / 1e6:.2f} MP in {total:.3f}s "
+                       f"(decode {decode:.3f}s, compute {compute:.3f}s, "
+                       f"encode {encode:.3f}s, "
+                       f"{pixels / 1e6 / max(total, 1e-9):.2f} MP/s)")
+
+    summary['seconds'] = time.perf_counter() - start
+    summary['megapixels_per_second'] = (summary['pixels'] / 1e6
+                                        / max(summary['seconds'], 1e-9))
+    report(f"{summary['processed']} processed, {summary['skipped']} skipped, "
+           f"{summary['failed']} failed: {summary['pixels'] / 1e6:.2f} MP in "
+           f"{summary['seconds']:.2f}s ({summary['megapixels_per_second']:.2f} MP/s)")
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Apply lab filters to many images in parallel.")
+    parser.add_argument('inputs', nargs='+', help="input files or globs")
+    parser.add_argument('-f', '--filter', required=True,
+                        help="filter chain, e.g. blur:7, sharpen:3, median:3, edges, "
+                             "invert or invert,edges")
+    parser.add_argument('-o', '--output', required=True, help="output directory")
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument('--force', action='store_true',
+                        help="reprocess up-to-date outputs")
+    parser.add_argument('--stream', action='store_true',
+                        help="stream PNG rows instead of loading whole images")
+    args = parser.parse_args(argv)
+    try:
+        stages = parse_filter_spec(args.filter)
+    except ValueError as error:
+        parser.error(str(error))
+    inputs = find_inputs(args.inputs)
+    if not inputs:
+        parser.error("no input files matched")
+    try:
+        summary = run_batch(inputs, args.output, stages, args.workers, args.force,
+                            args.stream)
+    except ValueError as error:
+        parser.error(str(error))
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+"""
+Filter throughput benchmarks
+- Times the lab filters, correlate in every boundary mode, the rank
+  filters (optionally against a naive reference), and loading and saving
+  on the test images and on synthetic images, and compares the results
+  against a stored JSON baseline
+- Memory is reported as peak RSS, peak traced bytes, and the blocks and
+  bytes each call leaves allocated; allocation counts are not measured
+
+Invoked as, for example:
+   python bench.py --save-baseline bench_baseline.json
+   python bench.py --sizes 1024,8192 --kernel-sizes 3,7,15,31 \
+       --compare bench_baseline.json
+   python bench.py --sizes 64 --kernel-sizes 3,9 --naive --no-test-images
+"""
+
+import argparse
+import glob
+import io
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import lab
+
+TEST_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def synthetic_image(height, width):
+    """
+    Returns a deterministic (height x width) test pattern, built a row at a
+    time so even 8k x 8k images are quick to make.
+    """
+    line = bytes((col * 17 + (col >> 4) * 5) & 255 for col in range(width))
+    pixels = bytearray()
+    for row in range(height):
+        shift = (row * 7) % width
+        pixels += line[shift:] + line[:shift]
+    return lab.GreyscaleImage(height, width, pixels)
+
+
+def graded_kernel(size):
+    """
+    Returns a (size x size) float kernel with graded weights summing to 1,
+    so correlate cannot take a box or integer shortcut. The weights repeat
+    every 5 and have low rank, so the benchmarks pin the direct method.
+    """
+    weights = [1 + (index % 5) for index in range(size * size)]
+    total = sum(weights)
+    return {'height': size, 'width': size,
+            'pixels': [weight / total for weight in weights]}
+
+
+def naive_rank_filtered(image, kernel_size, rank, boundary_behavior='extend'):
+    """
+    Reference rank filter: gathers every window pixel by pixel with
+    get_pixel_mode and sorts it.
+    """
+    growth = kernel_size // 2
+    offsets = range(growth * -1, kernel_size - growth)
+    pixels = []
+    for row in range(image['height']):
+        for col in range(image['width']):
+            window = sorted(lab.get_pixel_mode(image, row + down, col + across,
+                                               boundary_behavior)
+                            for down in offsets for across in offsets)
+            pixels.append(window[rank])
+    return lab.GreyscaleImage(image['height'], image['width'], bytearray(pixels))
+
+
+def load_source(source):
+    """
+    Returns the image for a source spec: ('file', path) or ('synthetic', height, width).
+    """
+    if source[0] == 'file':
+        return lab.load_greyscale_image(source[1])
+    return synthetic_image(source[1], source[2])
+
+
+def operations(kernel_sizes, naive=False):
+    """
+    Returns {name: function(image, source)} for every benchmarked operation.
+    Sorting medians are timed only for kernels small enough that "auto"
+    sorts; naive adds them for every size along with the pixel-by-pixel
+    reference, which takes minutes on large images.
+    """
+    ops = {'inverted': lambda image, source: lab.inverted(image),
+           'edges': lambda image, source: lab.edges(image)}
+    for size in kernel_sizes:
+        ops[f'blurred[{size}]'] = (
+            lambda image, source, size=size: lab.blurred(image, size))
+        ops[f'sharpened[{size}]'] = (
+            lambda image, source, size=size: lab.sharpened(image, size))
+        median = size ** 2 // 2
+        if naive or size <= lab.RANK_SORT_MAX_SIZE:
+            methods = ('sort', 'histogram')
+        else:
+            methods = ('histogram',)
+        for method in methods:
+            ops[f'median[{method},{size}]'] = (
+                lambda image, source, size=size, method=method:
+                lab.median_filtered(image, size, method=method))
+        if naive:
+            ops[f'median[naive,{size}]'] = (
+                lambda image, source, size=size, median=median:
+                naive_rank_filtered(image, size, median))
+        ops[f'min[{size}]'] = (
+            lambda image, source, size=size: lab.min_filtered(image, size))
+        for mode in ('zero', 'wrap', 'extend'):
+            ops[f'correlate[{mode},{size}]'] = (
+                lambda image, source, size=size, mode=mode:
+                lab.correlate(image, graded_kernel(size), mode, method='direct'))
+    return ops
+
+
+def file_operations():
+    """
+    Returns {name: function(image, source)} for the load/save benchmarks.
+    """
+    return {'load': lambda image, source: lab.load_greyscale_image(source[1]),
+            'save': lambda image, source: lab.save_greyscale_image(image, io.BytesIO())}
+
+
+def measure(name, source, kernel_sizes, repeat=3):
+    """
+    Benchmarks one operation on one source image and returns its metrics:
+    best time, megapixels per second, peak RSS of the process, peak traced
+    Python memory, and the memory blocks and bytes the call left allocated
+    (the result included), from tracemalloc snapshots taken around it.
+    These are retained blocks, not allocation counts: blocks allocated and
+    freed during the call do not show.
+    """
+    func = {**operations(kernel_sizes, naive=True), **file_operations()}[name]
+    image = load_source(source)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(image, source)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = func(image, source)
+    peak = tracemalloc.get_traced_memory()[1]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    # Leave out the first snapshot itself
+    own = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    retained = after.filter_traces(own).compare_to(before.filter_traces(own),
+                                                   'filename')
+    del result
+
+    megapixels = image['height'] * image['width'] / 1e6
+    return {'seconds': best,
+            'megapixels_per_second': megapixels / max(best, 1e-9),
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'peak_traced_bytes': peak,
+            'retained_blocks': sum(stat.count_diff for stat in retained),
+            'retained_bytes': sum(stat.size_diff for stat in retained)}
+
+
+def cases(sizes, kernel_sizes, test_images=True, naive=False):
+    """
+    Returns (case name, operation, source) for every benchmark.
+    """
+    sources = []
+    if test_images:
+        pattern = os.path.join(TEST_DIRECTORY, 'test_images', '*.png')
+        for path in sorted(glob.glob(pattern)):
+            sources.append((os.path.basename(path), ('file', path)))
+    for size in sizes:
+        sources.append((f'synthetic {size}x{size}', ('synthetic', size, size)))
+
+    result = []
+    for label, source in sources:
+        names = list(operations(kernel_sizes, naive))
+        if source[0] == 'file':
+            names += list(file_operations())
+        result += [(f'{name} {label}', name, source) for name in names]
+    return result
+
+
+def run(sizes=(256,), kernel_sizes=(3, 9), test_images=True, repeat=3, isolate=True,
+        naive=False, report=print):
+    """
+    Runs every benchmark and returns {case name: metrics}.
+
+    With isolate set, each case runs in a fresh process so that peak RSS
+    belongs to that case alone. naive adds the slow reference rank filters,
+    as in operations.
+    """
+    results = {}
+    for case, name, source in cases(sizes, kernel_sizes, test_images, naive):
+        if isolate:
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                metrics = pool.submit(measure, name, source, kernel_sizes,
+                                      repeat).result()
+        else:
+            metrics = measure(name, source, kernel_sizes, repeat)
+        results[case] = metrics
+        report(f"{case:<45} {metrics['megapixels_per_second']:9.3f} MP/s "
+               f"{metrics['peak_rss_kb'] / 1024:8.1f} MB RSS "
+               f"{metrics['peak_traced_bytes'] / 2**20:8.2f} MB traced "
+               f"{metrics['retained_blocks']:8d} blocks retained")
+    return results
+
+
+def regressions(results, baseline, threshold=0.2):
+    """
+    Returns (case, baseline MP/s, current MP/s) for every case whose
+    throughput fell more than `threshold` (a fraction) below the baseline.
+    """
+    slower = []
+    for case, metrics in results.items():
+        if case not in baseline:
+            continue
+        expected = baseline[case]['megapixels_per_second']
+        current = metrics['megapixels_per_second']
+        if current < expected * (1 - threshold):
+            slower.append((case, expected, current))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark lab filter throughput.",
+        epilog="Memory columns are peak RSS, peak traced bytes and the blocks still "
+               "allocated after each call (retained, not allocation counts).")
+    parser.add_argument('--sizes', default='256',
+                        help="comma-separated synthetic image sizes, "
+                             "e.g. 1024,4096,8192")
+    parser.add_argument('--kernel-sizes', default='3,9',
+                        help="comma-separated kernel sizes to sweep")
+    parser.add_argument('--no-test-images', action='store_true',
+                        help="only benchmark synthetic images")
+    parser.add_argument('--naive', action='store_true',
+                        help="also time sorting medians at every size and the naive "
+                             "reference (slow: use small sizes)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="timed runs per case (best is kept)")
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help="write results as a JSON baseline")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="fail on regressions against a baseline")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="allowed throughput drop as a fraction (default 0.2)")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    kernel_sizes = [int(size) for size in args.kernel_sizes.split(',') if size]
+    results = run(sizes, kernel_sizes, not args.no_test_images, args.repeat,
+                  naive=args.naive)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as handle:
+            baseline = json.load(handle)
+        slower = regressions(results, baseline, args.threshold)
+        for case, expected, current in slower:
+            print(f"REGRESSION {case}: {current:.3f} MP/s "
+                  f"vs baseline {expected:.3f} MP/s")
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
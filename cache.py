@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+"""
+Content-addressed result cache for lab filters
+- Keys results by a hash of the pixel buffer plus the operation and its
+  parameters, with a bounded in-memory LRU tier and an optional on-disk tier
+"""
+
+import copy
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+
+import lab
+
+
+def _pixel_bytes(image):
+    """
+    Returns (typecode, buffer) with the image's pixels in a contiguous buffer.
+    """
+    typecode, pixels = lab._typed_pixels(image['pixels'])
+    return typecode, memoryview(pixels).cast('B')
+
+
+def _image_size(image):
+    return memoryview(lab._typed_pixels(image['pixels'])[1]).nbytes
+
+
+class ResultCache:
+    """
+    Caches the results of blurred, sharpened, edges, inverted and correlate.
+
+    Results are kept in memory, least recently used first out, up to
+    max_bytes of pixel data. With a directory they are also written to disk,
+    where the least recently used files are removed beyond max_disk_bytes.
+    Hits return a copy, so callers may modify results freely.
+
+    Invoked as, for example:
+       cache = ResultCache(max_bytes=256 * 2**20, directory="cache/")
+       result = cache.blurred(image, 7)
+    """
+
+    def __init__(self, max_bytes=64 * 2**20, directory=None, max_disk_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0,
+                      'evictions': 0, 'disk_evictions': 0}
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._disk_bytes = sum(os.path.getsize(path) for path in self._disk_files())
+
+    @staticmethod
+    def key(op, image, *params):
+        """
+        Returns the cache key of an operation on an image: a BLAKE2b digest of
+        the pixel buffer, the image size and the parameters.
+        """
+        typecode, data = _pixel_bytes(image)
+        digest = hashlib.blake2b(digest_size=20)
+        header = (op, image['height'], image['width'], typecode, params)
+        digest.update(repr(header).encode())
+        digest.update(data)
+        return digest.hexdigest()
+
+    def _disk_files(self):
+        return [os.path.join(self.directory, name)
+                for name in os.listdir(self.directory) if name.endswith('.pickle')]
+
+    def _disk_path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def get(self, key):
+        """
+        Returns a copy of the cached result for key, or None.
+        """
+        result = self._memory.get(key)
+        if result is not None:
+            self._memory.move_to_end(key)
+            self.stats['hits'] += 1
+            return copy.deepcopy(result)
+        if self.directory is not None:
+            path = self._disk_path(key)
+            try:
+                with open(path, 'rb') as handle:
+                    result = pickle.load(handle)
+            except FileNotFoundError:
+                pass
+            except Exception:
+                # A corrupt or truncated file: drop it and recompute
+                self._remove_disk_file(path)
+            else:
+                os.utime(path)
+                self.stats['disk_hits'] += 1
+                self._remember(key, result)
+                return copy.deepcopy(result)
+        self.stats['misses'] += 1
+        return None
+
+    def put(self, key, result):
+        """
+        Stores a copy of result under key in every tier.
+        """
+        result = copy.deepcopy(result)
+        self._remember(key, result)
+        if self.directory is not None:
+            path = self._disk_path(key)
+            if not os.path.exists(path):
+                # Written aside and renamed, so readers never see a partial file
+                partial = f"{path}.{os.getpid()}.partial"
+                with open(partial, 'wb') as handle:
+                    pickle.dump(result, handle, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(partial, path)
+                self._disk_bytes += os.path.getsize(path)
+                self._evict_disk()
+
+    def _remember(self, key, result):
+        size = _image_size(result)
+        if size > self.max_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= _image_size(self._memory.pop(key))
+        self._memory[key] = result
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= _image_size(evicted)
+            self.stats['evictions'] += 1
+
+    def _remove_disk_file(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        self._disk_bytes -= size
+
+    def _evict_disk(self):
+        if self._disk_bytes <= self.max_disk_bytes:
+            return
+        for path in sorted(self._disk_files(), key=os.path.getmtime):
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            self._disk_bytes -= os.path.getsize(path)
+            os.remove(path)
+            self.stats['disk_evictions'] += 1
+
+    def clear(self):
+        """
+        Empties the memory tier.
+        """
+        self._memory.clear()
+        self._memory_bytes = 0
+
+    def _cached(self, op, func, image, *params):
+        key = self.key(op, image, *params)
+        result = self.get(key)
+        if result is None:
+            result = func(image, *params)
+            self.put(key, result)
+        return result
+
+    def inverted(self, image):
+        return self._cached('inverted', lab.inverted, image)
+
+    def blurred(self, image, kernel_size):
+        return self._cached('blurred', lab.blurred, image, kernel_size)
+
+    def sharpened(self, image, kernel_size):
+        return self._cached('sharpened', lab.sharpened, image, kernel_size)
+
+    def edges(self, image):
+        return self._cached('edges', lab.edges, image)
+
+    def correlate(self, image, kernel, boundary_behavior):
+        key = self.key('correlate', image, kernel['height'], kernel['width'],
+                       tuple(kernel['pixels']), boundary_behavior)
+        result = self.get(key)
+        if result is None:
+            result = lab.correlate(image, kernel, boundary_behavior)
+            if result is not None:
+                self.put(key, result)
+        return result
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""
+Frame sequence processing
+- Runs one filter chain over a long sequence of same-sized frames, reusing
+  preallocated frame and output buffers, with the next frame decoded and
+  the previous one encoded on background threads while the current one
+  is filtered
+
+Invoked as, for example:
+   python frames.py "clip/frame_*.png" --filter edges --output edges/
+"""
+
+import argparse
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import batch
+import lab
+
+
+class FrameFilter:
+    """
+    A filter chain compiled once for a sequence of frames.
+
+    Kernels and taps are built when the FrameFilter is made. Each call
+    filters one frame into the next of `buffers` preallocated output
+    buffers, so a result stays valid while the following buffers - 1 frames
+    are filtered. Buffers are reallocated only if the frame size changes.
+
+    Invoked as, for example:
+       edges = FrameFilter([('blur', 3), ('edges', None)])
+       for frame in frames:
+           result = edges(frame)
+    """
+
+    def __init__(self, stages, buffers=2):
+        self.stages = list(stages)
+        self.filters = [lab.row_filter(name, size) for name, size in self.stages]
+        self.buffers = buffers
+        self._outputs = deque()
+        self._size = None
+
+    def __call__(self, frame):
+        height, width = frame['height'], frame['width']
+        if self._size != (height, width):
+            self._size = (height, width)
+            self._outputs = deque(bytearray(height * width)
+                                  for _ in range(self.buffers))
+        out = self._outputs[0]
+        self._outputs.rotate(-1)
+
+        rows = lab._image_rows(frame)
+        for apply in self.filters:
+            rows = apply(rows, height, width)
+        position = 0
+        for line in rows:
+            out[position:position + width] = line
+            position += width
+        return lab.GreyscaleImage(height, width, out)
+
+
+def _decode_into(filename, buffer):
+    """
+    Decodes a frame into a reused buffer. L frames go from PIL's raw bytes
+    straight into the buffer and 8-bit colour frames are converted from
+    them with greyscale_bytes; other modes are loaded with
+    load_greyscale_image and copied.
+    """
+    with open(filename, 'rb') as handle:
+        img = Image.open(handle)
+        if img.mode == 'L':
+            buffer[:] = img.tobytes()
+        elif img.mode in ('LA', 'RGB', 'RGBA'):
+            buffer[:] = lab.greyscale_bytes(img.tobytes(), img.mode,
+                                            len(img.getbands()))
+        else:
+            handle.seek(0)
+            buffer[:] = lab.load_greyscale_image(handle)['pixels']
+        width, height = img.size
+    return lab.GreyscaleImage(height, width, buffer)
+
+
+def decoded_frames(filenames, prefetch=2):
+    """
+    Yields the frames of the given files in order, decoding up to `prefetch`
+    frames ahead on a background thread. Frames share prefetch + 1 input
+    buffers, so each frame stays valid until the next one is requested.
+    """
+    buffers = [bytearray() for _ in range(prefetch + 1)]
+    pending = deque()
+    filenames = iter(filenames)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        for index, filename in enumerate(filenames):
+            buffer = buffers[index % len(buffers)]
+            pending.append(pool.submit(_decode_into, filename, buffer))
+            if len(pending) > prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def process_frames(frames, stages, buffers=2):
+    """
+    Yields the filtered version of each frame from an iterator of frames,
+    reusing `buffers` output buffers (see FrameFilter).
+    """
+    frame_filter = FrameFilter(stages, buffers)
+    for frame in frames:
+        yield frame_filter(frame)
+
+
+def process_sequence(in_filenames, out_filenames, stages, prefetch=2, encode_ahead=2,
+                     report=None):
+    """
+    Filters a sequence of frame files into out_filenames and returns a
+    summary dict.
+
+    Up to `prefetch` frames are decoded ahead and up to `encode_ahead`
+    finished frames are encoded behind the one being filtered, each on its
+    own thread; PIL releases the GIL while it decodes and compresses, so
+    compute stays busy. Memory stays flat however long the sequence is:
+    every frame reuses the same input and output buffers.
+    """
+    summary = {'frames': 0, 'pixels': 0}
+    start = time.perf_counter()
+    pending = deque()
+    frames = decoded_frames(in_filenames, prefetch)
+    results = process_frames(frames, stages, buffers=encode_ahead + 1)
+    with ThreadPoolExecutor(max_workers=1) as encoder:
+        for out_filename, result in zip(out_filenames, results):
+            pending.append(encoder.submit(lab.save_greyscale_image, result,
+                                          out_filename))
+            summary['frames'] += 1
+            summary['pixels'] += result['height'] * result['width']
+            if report is not None:
+                report(f"{out_filename}: frame {summary['frames']}")
+            # The output buffer comes round again after encode_ahead more frames
+            while len(pending) > encode_ahead:
+                pending.popleft().result()
+        for future in pending:
+            future.result()
+
+    summary['seconds'] = time.perf_counter() - start
+    summary['frames_per_second'] = summary['frames'] / max(summary['seconds'], 1e-9)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Apply lab filters to a sequence of frames.")
+    parser.add_argument('inputs', nargs='+',
+                        help="frame files or globs, in frame order")
+    parser.add_argument('-f', '--filter', required=True,
+                        help="filter chain, e.g. edges, blur:3 or blur:3,edges")
+    parser.add_argument('-o', '--output', required=True, help="output directory")
+    parser.add_argument('--prefetch', type=int, default=2, help="frames decoded ahead")
+    args = parser.parse_args(argv)
+    try:
+        stages = batch.parse_filter_spec(args.filter)
+    except ValueError as error:
+        parser.error(str(error))
+    inputs = batch.find_inputs(args.inputs)
+    if not inputs:
+        parser.error("no input files matched")
+    try:
+        outputs = batch.output_names(inputs, args.output)
+    except ValueError as error:
+        parser.error(str(error))
+    for directory in {os.path.dirname(name) for name in outputs}:
+        os.makedirs(directory, exist_ok=True)
+    summary = process_sequence(inputs, outputs, stages, args.prefetch)
+    print(f"{summary['frames']} frames in {summary['seconds']:.2f}s "
+          f"({summary['frames_per_second']:.2f} frames/s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,9 +6,432 @@ Image Processing Project
 Author: Dylan Espey
 """
 
+import cmath
+import cProfile
+import functools
+import json
 import math
+import mmap
+import os
+import pstats
+import struct
+import sys
+import time
+import tracemalloc
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from fractions import Fraction
+from itertools import accumulate, chain, compress
+from multiprocessing import shared_memory
+from operator import add, mul, sub
+
+from PIL import Image, ImageMath
+
+# INSTRUMENTATION
+
+# Active sink, or None while instrumentation is off
+_sink = None
+
+
+class Sink:
+    """
+    Receives instrumentation events. begin(stage) runs before every
+    instrumented call and record(stage, seconds, counters) after it, or
+    abort(stage) if the call raised.
+    """
+
+    def begin(self, stage):
+        pass
+
+    def record(self, stage, seconds, counters):
+        pass
+
+    def abort(self, stage):
+        pass
+
+
+class MemorySink(Sink):
+    """
+    Keeps every event, plus per-stage totals of calls, seconds and counters.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.totals = {}
+
+    def record(self, stage, seconds, counters):
+        self.events.append((stage, seconds, counters))
+        total = self.totals.setdefault(stage, {'calls': 0, 'seconds': 0.0})
+        total['calls'] += 1
+        total['seconds'] += seconds
+        for name, value in counters.items():
+            total[name] = total.get(name, 0) + value
+
+
+class JsonLinesSink(Sink):
+    """
+    Writes each event as one line of JSON to a text file object.
+    """
+
+    def __init__(self, handle):
+        self.handle = handle
+
+    def record(self, stage, seconds, counters):
+        event = {'stage': stage, 'seconds': seconds, **counters}
+        self.handle.write(json.dumps(event) + '\n')
+
+
+class ProfileSink(Sink):
+    """
+    Captures the next call of one stage with cProfile and tracemalloc.
+    Afterwards `stats` holds the pstats.Stats, `snapshot` the tracemalloc
+    snapshot and `peak` the peak traced memory in bytes.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.stats = None
+        self.snapshot = None
+        self.peak = None
+        self._profile = None
+
+    def begin(self, stage):
+        if stage == self.stage and self.stats is None and self._profile is None:
+            tracemalloc.start()
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def record(self, stage, seconds, counters):
+        if stage == self.stage and self._profile is not None:
+            self._profile.disable()
+            self.snapshot = tracemalloc.take_snapshot()
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.stats = pstats.Stats(self._profile)
+            self._profile = None
+
+    def abort(self, stage):
+        # A failed call is dropped, so the next call is captured afresh
+        if stage == self.stage and self._profile is not None:
+            self._profile.disable()
+            tracemalloc.stop()
+            self._profile = None
+
+
+@contextmanager
+def instrumentation(sink):
+    """
+    Sends instrumentation events to sink inside a with block, e.g.
+       with instrumentation(MemorySink()) as sink:
+           blurred(image, 7)
+       print(sink.totals)
+    """
+    global _sink
+    previous, _sink = _sink, sink
+    try:
+        yield sink
+    finally:
+        _sink = previous
+
+
+def _instrumented(stage, counters=None):
+    """
+    Decorator timing calls to a function as `stage`. counters(args, result)
+    returns the counters to record. While no sink is active the only cost
+    is one global lookup per call.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            sink = _sink
+            if sink is None:
+                return func(*args, **kwargs)
+            sink.begin(stage)
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                sink.abort(stage)
+                raise
+            seconds = time.perf_counter() - start
+            sink.record(stage, seconds, counters(args, result) if counters else {})
+            return result
+        return wrapper
+    return decorate
+
+
+def _pixel_counter(args, result):
+    return {'pixels': args[0]['height'] * args[0]['width']}
+
+
+def _correlate_counter(args, result):
+    image, kernel = args[0], args[1]
+    pixels = image['height'] * image['width']
+    return {'pixels': pixels,
+            'kernel_taps': pixels * kernel['height'] * kernel['width']}
+
+
+def _load_counter(args, result):
+    counters = {'pixels': result['height'] * result['width']}
+    if isinstance(args[0], (str, bytes, os.PathLike)):
+        counters['bytes_read'] = os.path.getsize(args[0])
+    return counters
+
+
+def _save_counter(args, result):
+    counters = _pixel_counter(args, result)
+    if isinstance(args[1], (str, bytes, os.PathLike)):
+        counters['bytes_written'] = os.path.getsize(args[1])
+    elif hasattr(args[1], 'tell'):
+        counters['bytes_written'] = args[1].tell()
+    return counters
+
+
+# IMAGE REPRESENTATION
+
+_IMAGE_KEYS = ('height', 'width', 'pixels')
+
+
+class GreyscaleImage:
+    """
+    Compact 8-bit image: one byte per pixel in a flat, row-major 'pixels'
+    buffer (bytearray, array('B') or memoryview).
+    Supports the dictionary style access used elsewhere, e.g. image['height'].
+    """
+    __slots__ = _IMAGE_KEYS
+
+    def __init__(self, height, width, pixels=None):
+        self.height = height
+        self.width = width
+        self.pixels = bytearray(height * width) if pixels is None else pixels
+
+    def __getitem__(self, key):
+        if key not in _IMAGE_KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in _IMAGE_KEYS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in _IMAGE_KEYS
+
+    def __iter__(self):
+        return iter(_IMAGE_KEYS)
+
+    def keys(self):
+        return _IMAGE_KEYS
+
+    def __eq__(self, other):
+        try:
+            return (self.height == other['height'] and self.width == other['width']
+                    and list(self.pixels) == list(other['pixels']))
+        except (KeyError, TypeError):
+            return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}(height={self.height}, width={self.width})"
+
+
+class FloatImage(GreyscaleImage):
+    """
+    Unclipped intermediate result, such as the output of correlate.
+    Pixels live in an array: 'd' for real values, or 'q' when every value is
+    an integer. round_and_clip_image narrows it to a GreyscaleImage in place.
+    """
+    __slots__ = ()
+
+    def __init__(self, height, width, pixels=None, typecode='d'):
+        if pixels is None:
+            pixels = array(typecode, [0]) * (height * width)
+        super().__init__(height, width, pixels)
+
+    @classmethod
+    def from_values(cls, height, width, values):
+        """
+        Packs a sequence of numbers, keeping integers exact where possible.
+        """
+        if not isinstance(values, list):
+            # array() would read a bytes-like object as raw machine values
+            values = list(values)
+        try:
+            pixels = array('q', values)
+        except (TypeError, OverflowError):
+            pixels = array('d', values)
+        return cls(height, width, pixels)
+
+
+def _apply_to_plane(task):
+    """
+    Worker job for ColorImage.map: runs func on one plane.
+    """
+    func, plane, args, kwargs = task
+    return func(plane, *args, **kwargs)
+
+
+class ColorImage:
+    """
+    Planar colour image: one GreyscaleImage per channel of mode ("RGB" or
+    "RGBA"), each a contiguous buffer, rather than a tuple per pixel.
+    inverted, correlate, round_and_clip_image, blurred, sharpened, edges and
+    the rank filters accept one and filter every colour plane; the alpha
+    plane is carried over unchanged.
+    """
+    __slots__ = ('height', 'width', 'mode', 'planes')
+    _keys = __slots__
+
+    def __init__(self, height, width, mode, planes):
+        if len(planes) != len(mode):
+            raise ValueError(f"{mode} needs {len(mode)} planes, got {len(planes)}")
+        self.height = height
+        self.width = width
+        self.mode = mode
+        self.planes = list(planes)
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __eq__(self, other):
+        if not isinstance(other, ColorImage):
+            return NotImplemented
+        return ((self.height, self.width, self.mode)
+                == (other.height, other.width, other.mode)
+                and self.planes == other.planes)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return (f"ColorImage(height={self.height}, width={self.width}, "
+                f"mode={self.mode!r})")
+
+    def map(self, func, *args, processes=1, alpha=False, **kwargs):
+        """
+        Returns a ColorImage of func(plane, *args, **kwargs) for each colour
+        plane (and the alpha plane too if alpha is set). With processes > 1
+        the planes are filtered in a pool of that many processes. An out
+        keyword must be a ColorImage of the same size; its planes receive
+        the results. If func returns a tuple of images, such as edges with
+        direction=True, a tuple of ColorImages is returned, out receiving
+        the first.
+        """
+        out = kwargs.pop('out', None)
+        if out is not None:
+            _check_out(self, out)
+        count = len(self.planes)
+        if 'A' in self.mode and not alpha:
+            count -= 1
+        if processes > 1:
+            tasks = [(func, plane, args, kwargs) for plane in self.planes[:count]]
+            with ProcessPoolExecutor(max_workers=min(processes, count)) as pool:
+                results = list(pool.map(_apply_to_plane, tasks))
+        elif out is not None:
+            results = [func(plane, *args, out=target, **kwargs)
+                       for plane, target in zip(self.planes, out.planes[:count])]
+        else:
+            results = [func(plane, *args, **kwargs) for plane in self.planes[:count]]
+
+        if results and isinstance(results[0], tuple):
+            return tuple(self._assembled(list(planes), out if index == 0 else None)
+                         for index, planes in enumerate(zip(*results)))
+        return self._assembled(results, out)
+
+    def _assembled(self, planes, out):
+        """
+        Returns a ColorImage of the filtered planes followed by copies of
+        the remaining (alpha) planes, or stores them all into out.
+        """
+        rest = self.planes[len(planes):]
+        if out is None:
+            planes += [GreyscaleImage(self.height, self.width,
+                                      bytearray(plane['pixels']))
+                       for plane in rest]
+            return ColorImage(self.height, self.width, self.mode, planes)
+        for target, plane in zip(out.planes, planes + rest):
+            # Planes filtered with out= are already in place
+            if plane is not target:
+                _store(target, 0, plane['pixels'])
+        return out
+
+
+def _planar(func):
+    """
+    Decorator letting an image function take a ColorImage, which it then
+    applies to every colour plane (see ColorImage.map).
+    """
+    @functools.wraps(func)
+    def wrapper(image, *args, **kwargs):
+        if isinstance(image, ColorImage):
+            return image.map(wrapper, *args, **kwargs)
+        return func(image, *args, **kwargs)
+    return wrapper
+
+
+class ScratchPool:
+    """
+    Reusable output images for long-running workers, so that filters given
+    out= do not allocate full-size buffers after warm-up.
+
+    Invoked as, for example:
+       pool = ScratchPool()
+       for image in images:
+           result = blurred(image, 5, out=pool.image(image['height'], image['width']))
+    """
+
+    def __init__(self):
+        self._images = {}
+
+    def image(self, height, width, typecode='B', name=None):
+        """
+        Returns the pooled (height x width) image for typecode ('B' for a
+        GreyscaleImage, 'q' or 'd' for a FloatImage) and name, making it on
+        first use. Pass distinct names for buffers needed at the same time.
+        """
+        key = (name, height, width, typecode)
+        image = self._images.get(key)
+        # round_and_clip_image may have narrowed a pooled FloatImage in place
+        if image is None or _typed_pixels(image.pixels)[0] != typecode:
+            if typecode == 'B':
+                image = GreyscaleImage(height, width)
+            else:
+                image = FloatImage(height, width, typecode=typecode)
+            self._images[key] = image
+        return image
+
+    def clear(self):
+        self._images.clear()
+
+
+# Pixels handled at a time by the out= variants of the filters
+BAND_PIXELS = 1 << 10
+
+
+def _check_out(image, out):
+    if (out['height'], out['width']) != (image['height'], image['width']):
+        raise ValueError(f"out is {out['height']}x{out['width']}, "
+                         f"expected {image['height']}x{image['width']}")
+
+
+def _store(out, start, values):
+    """
+    Writes values into out's pixels from index start on. Arrays and
+    memoryviews (mapped raw images) only take values packed in their own
+    typecode.
+    """
+    pixels = out['pixels']
+    if isinstance(pixels, array):
+        values = array(pixels.typecode, values)
+    elif isinstance(pixels, memoryview):
+        values = array(pixels.format, values)
+    pixels[start:start + len(values)] = values
 
-from PIL import Image
 
 def get_1d_location(image, row, col):       
     return (image['width'] * row) + col
@@ -38,14 +461,16 @@ def get_pixel_extend(image, row, col):
         col = image['width'] - 1
     return get_pixel(image, row, col)
 
+PIXEL_MODES = {'zero':get_pixel_zero, 'wrap':get_pixel_wrap, 'extend':get_pixel_extend}
+
+
 def get_pixel_mode(image, row, col, mode="zero"):
     """
     Get pixel using edge modes "zero", "wrap", "extend"
     row relates to height, col relates to width
     i.e; the number of rows and the number of cols
     """
-    modes = {'zero':get_pixel_zero, 'wrap':get_pixel_wrap, 'extend':get_pixel_extend}
-    return modes[mode](image,row,col)
+    return PIXEL_MODES[mode](image,row,col)
 
 
 
@@ -55,26 +480,250 @@ def set_pixel(image, row, col, color):
 
 
 def apply_per_pixel(image, func):
-    result = {
-        "height": image["height"],
-        "width": image["width"],
-        "pixels": image['pixels'].copy(),
-    }
-    for row in range(image["height"]):
-        for col in range(image["width"]):
-            color = get_pixel(image, row, col)
-            new_color = func(color)
-            set_pixel(result, row, col, new_color)
-    return result
+    """
+    Returns a new image with func applied to every pixel. Results that all
+    fit in 8 bits give a GreyscaleImage, anything else a FloatImage.
+
+    For 8-bit images func is evaluated once for each value that occurs and
+    the results are applied in bulk as a lookup table.
+    """
+    pixels = image['pixels']
+    if _typed_pixels(pixels)[0] == 'B':
+        results = {color: func(color) for color in set(pixels)}
+        try:
+            table = bytes(results.get(color, 0) for color in range(256))
+        except (TypeError, ValueError):
+            values = list(map(results.__getitem__, pixels))
+        else:
+            return apply_point_table(image, table)
+    else:
+        values = [func(color) for color in pixels]
+    try:
+        return GreyscaleImage(image["height"], image["width"], bytearray(values))
+    except (TypeError, ValueError):
+        return FloatImage.from_values(image["height"], image["width"], values)
+
+
+# POINT OPERATIONS
+
+def point_table(func):
+    """
+    Returns the 256-entry lookup table (bytes) of func over every 8-bit value,
+    with each result rounded and clipped to [0, 255].
+    """
+    return bytes([max(0, min(255, round(func(color)))) for color in range(256)])
+
+
+def compose_point_tables(*tables):
+    """
+    Merges a chain of lookup tables, applied left to right, into one table.
+    """
+    combined = bytes(range(256))
+    for table in tables:
+        combined = combined.translate(table)
+    return combined
+
+
+def apply_point_table(image, table, out=None):
+    """
+    Returns a new GreyscaleImage mapping every pixel of an 8-bit image
+    through a 256-entry lookup table. Wider pixels raise ValueError.
+
+    With out (a GreyscaleImage of the same size, possibly image itself) the
+    result is written into it a band at a time and out is returned.
+    """
+    pixels = image['pixels']
+    if _typed_pixels(pixels)[0] != 'B':
+        raise ValueError("Lookup tables need 8-bit pixels")
+    if out is not None:
+        _check_out(image, out)
+        for start in range(0, len(pixels), BAND_PIXELS):
+            out['pixels'][start:start + BAND_PIXELS] = (
+                bytes(pixels[start:start + BAND_PIXELS]).translate(table))
+        return out
+    if not isinstance(pixels, bytearray):
+        pixels = bytearray(pixels)
+    return GreyscaleImage(image['height'], image['width'], pixels.translate(table))
 
 
-def inverted(image):
-    return apply_per_pixel(image, lambda color: 255-color)
+def apply_point_ops(image, *funcs):
+    """
+    Applies a chain of point operations, each rounded and clipped to 8 bits,
+    in a single pass through one merged lookup table.
+    """
+    return apply_point_table(image, compose_point_tables(*map(point_table, funcs)))
+
+
+def gamma_table(gamma):
+    """
+    Tone curve 255 * (v / 255) ** gamma.
+    """
+    return point_table(lambda color: 255 * (color / 255) ** gamma)
+
+
+def threshold_table(level):
+    """
+    Maps values of at least `level` to 255 and the rest to 0.
+    """
+    return point_table(lambda color: 255 if color >= level else 0)
+
+
+def contrast_stretch_table(low, high):
+    """
+    Linearly stretches [low, high] onto [0, 255], clipping values outside.
+    """
+    return point_table(lambda color: (color - low) * 255 / (high - low))
+
+
+INVERT_TABLE = point_table(lambda color: 255-color)
+
+
+@_planar
+@_instrumented('inverted', _pixel_counter)
+def inverted(image, out=None):
+    """
+    Returns 255 - v for every pixel. 8-bit images go through INVERT_TABLE;
+    wider pixels (a FloatImage) are inverted value by value, unclipped.
+    """
+    if _typed_pixels(image['pixels'])[0] == 'B':
+        return apply_point_table(image, INVERT_TABLE, out)
+    return _stored(apply_per_pixel(image, lambda color: 255 - color), out)
 
 
 # HELPER FUNCTIONS
 
-def correlate(image, kernel, boundary_behavior):
+def get_boundary_index(index, size, mode="zero"):
+    """
+    Maps a row or column index that may fall outside of [0, size) back onto
+    the image using edge modes "zero", "wrap", "extend".
+    Returns None where "zero" would read a 0 pixel.
+    """
+    if 0 <= index < size:
+        return index
+    if mode == 'wrap':
+        return index % size
+    if mode == 'extend':
+        return 0 if index < 0 else size - 1
+    return None
+
+
+def _kernel_taps(kernel):
+    """
+    Returns (growth, start, taps) for a kernel: taps are the non-zero
+    (row offset, col offset, value) entries, in summation order, and start is
+    the 0 or 0.0 every sum begins from. growth is how far taps reach from
+    the center in any direction.
+    """
+    height, width, values = kernel['height'], kernel['width'], kernel['pixels']
+    growth = max(height, width) // 2
+    taps = [(row - height // 2, col - width // 2, values[row * width + col])
+            for row in range(height) for col in range(width)]
+    start = 0.0 if any(isinstance(value, float) for _, _, value in taps) else 0
+    # Zero taps add nothing, so they are skipped
+    taps = [tap for tap in taps if tap[2] != 0]
+    return growth, start, taps
+
+
+def _image_rows(image):
+    """
+    Yields the pixels of each row of the image in order.
+    """
+    width, pixels = image['width'], image['pixels']
+    for row in range(image['height']):
+        yield pixels[row * width:(row + 1) * width]
+
+
+def _row_reader(pixels, width):
+    """
+    Returns a function reading one row of a flat pixel buffer.
+    """
+    return lambda row: pixels[row * width:(row + 1) * width]
+
+
+def _pad_rows(read_row, height, width, growth, boundary_behavior, row_start, row_stop):
+    """
+    Returns a flat border buffer holding source rows
+    [row_start - growth, row_stop + growth), each with `growth` extra columns
+    on both sides, filled in for the edge mode.
+
+    Rows and columns inside the image are copied as whole slices; only the
+    border goes through get_boundary_index.
+    """
+    left = [get_boundary_index(col, width, boundary_behavior)
+            for col in range(growth * -1, 0)]
+    right = [get_boundary_index(col, width, boundary_behavior)
+             for col in range(width, width + growth)]
+    buffer = []
+    for row in range(row_start - growth, row_stop + growth):
+        source = get_boundary_index(row, height, boundary_behavior)
+        if source is None:
+            line = [0] * width
+        else:
+            line = read_row(source)
+        buffer.extend([0 if col is None else line[col] for col in left])
+        buffer.extend(line)
+        buffer.extend([0 if col is None else line[col] for col in right])
+    return buffer
+
+
+def _correlate_padded(buffer, rows, width, growth, start, taps):
+    """
+    Returns the correlated values of `rows` output rows from a border buffer
+    made by _pad_rows, as a flat list.
+
+    Every tap adds one contiguous slice of the buffer, shifted by the tap's
+    offset, across all rows at once; the 2 * growth border columns computed
+    between rows are dropped at the end.
+    """
+    padded_width = width + 2 * growth
+    span = (rows - 1) * padded_width + width
+    acc = [start] * span
+    for y_offset, x_offset, value in taps:
+        offset = (y_offset + growth) * padded_width + x_offset + growth
+        acc = [total + value * pixel
+               for total, pixel in zip(acc, buffer[offset:offset + span])]
+    if growth == 0:
+        return acc
+    result_pixels = []
+    for row in range(rows):
+        result_pixels += acc[row * padded_width:row * padded_width + width]
+    return result_pixels
+
+
+def _correlate_rows(read_row, height, width, growth, start, taps, boundary_behavior,
+                    row_start=0, row_stop=None):
+    """
+    Returns the correlated values of output rows [row_start, row_stop) as a
+    flat list. read_row(row) gives the pixels of a source row; only the rows
+    those outputs touch are read and padded.
+    """
+    if row_stop is None:
+        row_stop = height
+    if row_stop <= row_start:
+        return []
+    buffer = _pad_rows(read_row, height, width, growth, boundary_behavior,
+                       row_start, row_stop)
+    return _correlate_padded(buffer, row_stop - row_start, width, growth, start, taps)
+
+
+def pad_image(image, growth, boundary_behavior):
+    """
+    Returns a copy of the image with `growth` extra rows and columns on every
+    side, filled in using edge modes "zero", "wrap" or "extend".
+    """
+    height, width = image['height'], image['width']
+    buffer = _pad_rows(_row_reader(image['pixels'], width), height, width, growth,
+                       boundary_behavior, 0, height)
+    padded_height, padded_width = height + 2 * growth, width + 2 * growth
+    try:
+        return GreyscaleImage(padded_height, padded_width, bytearray(buffer))
+    except (TypeError, ValueError):
+        return FloatImage.from_values(padded_height, padded_width, buffer)
+
+
+@_planar
+@_instrumented('correlate', _correlate_counter)
+def correlate(image, kernel, boundary_behavior, workers=1, method='auto', out=None):
     """
     Computes the result of correlating the given image with the given kernel.
 
@@ -82,50 +731,114 @@ def correlate(image, kernel, boundary_behavior):
 
     kernel: Dictionary ('height', 'width' 'pixels')
     width is redundant, but allows us to use the other helper functions intended for the base image representation
+
+    `method` is "direct", "separable" (kernels that kernel_plan splits
+    into rank 1 terms), "fft", or
+    "auto" to pick the cheapest by correlation_costs. The direct method works
+    a whole row at a time: every source row is padded once, then each kernel
+    tap adds a shifted slice of it into the output row. Taps are summed in the
+    same order as the per-pixel definition, so results are bit-identical.
+    The other methods give identical integer results and float results within
+    FLOAT_TOLERANCE, so after round_and_clip_image they can only differ where
+    a sum lies within that tolerance of a rounding boundary.
+    workers > 1 splits the rows of the direct method across processes
+    (see correlate_parallel): "auto" then means "direct", so results match
+    correlate(..., method='direct') exactly, and asking for "separable" or
+    "fft" with workers raises ValueError.
+
+    With out (a FloatImage of the same size; use typecode 'd' for float
+    kernels) the result is written into it and out is returned. The direct
+    method then works a band of rows at a time without full-size
+    temporaries, and out may be image itself.
     """
-    
-    def kernel_op(x, y, midpoint):
-        ''' Multiplies image Pixel(x+ x offset, y+ y offset) by corresponding kernel (midpoint + y offset, midpoint + x offset)'''
-        k_value = get_pixel_mode(kernel, midpoint + y, midpoint + x, boundary_behavior)
-        image_value = get_pixel_mode(image, row + y, col + x, boundary_behavior)
-        return image_value * k_value
-    
-    
-    def apply_kernel(kernel):
-        ''' Iterates across (n x n) kernel range, selects corresponding kernel values in image '''
-        growth = kernel['height'] // 2
-        final = 0
-        for y_offset in range(growth * -1, growth + 1):
-            for x_offset in range(growth * -1, growth + 1):
-                final += kernel_op(x_offset, y_offset, growth)
-        return final
-
-        
     # Exit function if edge boundary behaviour is not a valid option
     if boundary_behavior not in ['zero', 'wrap', 'extend']:
         return None
-    
-    # Image Data frame
-    result = {
-        "height": image["height"],
-        "width": image["width"],
-        "pixels": image['pixels'].copy(),
-    }
-
-    # Iterate over each row and column
-    for row in range(0, image["height"]):
-        for col in range(0, image["width"]):
-            # Perform a kernel operation
-            kValue = apply_kernel(kernel)
-            # Set Pixel to kernel value
-            set_pixel(result, row, col, kValue)
+    if out is not None:
+        _check_out(image, out)
+    if workers > 1:
+        if method not in ('auto', 'direct'):
+            raise ValueError(f"Only the direct method runs on workers, not {method!r}")
+        result = correlate_parallel(image, kernel, boundary_behavior, workers)
+        return _stored(result, out)
 
-    return result
-    
-    
+    height, width = image['height'], image['width']
+    if method == 'auto':
+        method = correlation_method(height, width, kernel)
+    if method == 'direct' and out is not None:
+        return _correlate_into(image, kernel, boundary_behavior, out)
+    return _stored(_correlate_method(image, kernel, boundary_behavior, method), out)
+
+
+def _stored(result, out):
+    """
+    Copies a result into out, if given, and returns whichever holds it.
+    """
+    if out is None:
+        return result
+    _store(out, 0, result['pixels'])
+    return out
+
+
+def _correlate_into(image, kernel, boundary_behavior, out):
+    """
+    Direct correlation written into out a band of rows at a time. When out
+    is the image itself, the input rows a later band still reads are copied
+    before the band above overwrites them.
+    """
+    height, width, pixels = image['height'], image['width'], image['pixels']
+    growth, start, taps = _kernel_taps(kernel)
+    in_place = out['pixels'] is pixels
+    saved = {}
+    if in_place and boundary_behavior == 'wrap':
+        # The last rows wrap around to read the first ones
+        saved = {row: pixels[row * width:(row + 1) * width]
+                 for row in range(min(growth, height))}
+
+    def read_row(row):
+        line = saved.get(row)
+        return pixels[row * width:(row + 1) * width] if line is None else line
+
+    band = max(1, BAND_PIXELS // max(1, width))
+    for row_start in range(0, height, band):
+        row_stop = min(height, row_start + band)
+        values = _correlate_rows(read_row, height, width, growth, start, taps,
+                                 boundary_behavior, row_start, row_stop)
+        if in_place:
+            for row in range(max(0, row_stop - growth), row_stop):
+                saved.setdefault(row, pixels[row * width:(row + 1) * width])
+            for row in [row for row in saved if growth <= row < row_stop - growth]:
+                del saved[row]
+        _store(out, row_start * width, values)
+    return out
+
+
+def _correlate_method(image, kernel, boundary_behavior, method):
+    """
+    Runs one correlate method, returning a new FloatImage.
+    """
+    height, width = image['height'], image['width']
+    if method == 'fft':
+        return _correlate_fft(image, kernel, boundary_behavior)
+    if method == 'separable':
+        return _correlate_separable(image, kernel, boundary_behavior)
+    if method != 'direct':
+        raise ValueError(f"Unknown correlation method: {method!r}")
+    growth, start, taps = _kernel_taps(kernel)
+    result_pixels = _correlate_rows(_row_reader(image['pixels'], width), height, width,
+                                    growth, start, taps, boundary_behavior)
+    return FloatImage.from_values(height, width, result_pixels)
 
 
+def _round_and_clip_values(values):
+    """
+    Rounds and clips a sequence of numbers into a bytearray.
+    """
+    return bytearray([max(0, min(255, round(value))) for value in values])
 
+
+@_planar
+@_instrumented('round_and_clip', _pixel_counter)
 def round_and_clip_image(image):
     """
     Given a dictionary, ensures that the values in the "pixels" list are all
@@ -134,7 +847,18 @@ def round_and_clip_image(image):
     Any locations with values higher than 255 in the input should have value
     255 in the output; and any locations with values lower than 0 in the input
     should have value 0 in the output.
+
+    A FloatImage is narrowed in place into a GreyscaleImage.
     """
+    if isinstance(image, GreyscaleImage):
+        pixels = image.pixels
+        if isinstance(pixels, (bytes, bytearray)) or (isinstance(pixels, memoryview)
+                                                      and pixels.format == 'B'):
+            return image
+        image.pixels = _round_and_clip_values(image.pixels)
+        image.__class__ = GreyscaleImage
+        return image
+
     for pixel in range(0, len(image['pixels'])):
         # Rounds each pixel, then guarantees it falls within 0, 255 range
         image['pixels'][pixel] = max( 0, min(255, round(image['pixels'][pixel]) ))
@@ -146,115 +870,1423 @@ def generate_kernel(size, f):
               'pixels': [f for pixel in range(0, size*size)]}
     return kernel
 
-# FILTERS
 
-def blurred(image, kernel_size):
+def sharpen_kernel(size):
     """
-    Returns a new image representing the result of applying a box blur (with the
-    given kernel size) to the given input image.
-
+    Returns the unsharp mask kernel scaled by size**2 into integers:
+    2 * size**2 at the center minus 1 everywhere.
     """
-    # Generates a gaussian blur kernel
-    kernel = generate_kernel(kernel_size, 1/(kernel_size**2))
+    kernel = generate_kernel(size, -1)
+    kernel['pixels'][get_1d_location(kernel, size // 2, size // 2)] += 2 * size**2
+    return kernel
 
-    # Compute the correlation of the image for a given kernel
-    result = correlate(image, kernel, 'extend')
-    
-    # Return validated image
-    return round_and_clip_image(result)
 
-def sharpened(image, kernel_size):
+def _box_sum_rows(rows, height, width, kernel_size):
     """
-    Sharpening Formula: S(r,c) = 2*I(r,c) - Blur(r,c) = - Blur(r,c) + 2*I(r,c)
-    Returns a new image representing the result of applying an unsharp mask (with the
-    given kernel size) to the given input image.
+    Yields (row pixels, window sums) for each row in order, where the window
+    sums cover (kernel_size x kernel_size) windows with "extend" edges. As
+    with the kernels of correlate, windows reach kernel_size // 2 pixels
+    before the center and kernel_size - 1 - kernel_size // 2 after, one
+    fewer for even sizes.
 
+    Rows are pulled from the `rows` iterator only as they are needed and just
+    kernel_size of them are kept, so this also serves streaming.
     """
-    # Generates a gaussian kernel with negative values, and add 2 * Identity kernel to it (add 2 to the midpoint)
-    kernel = generate_kernel(kernel_size, -1/(kernel_size**2))
-    midpoint = get_1d_location(kernel, kernel['height'] // 2, kernel['height'] // 2)
-    kernel['pixels'][midpoint] += 2
+    before = kernel_size // 2
+    after = kernel_size - 1 - before
 
+    # Horizontal window sums of a row, from the prefix sums of the padded row
+    columns = [get_boundary_index(col, width, 'extend')
+               for col in range(before * -1, width + after)]
 
-    # Compute the correlation of the image for a given kernel
-    result = correlate(image, kernel, 'extend')
-    # Return validated image
-    return round_and_clip_image(result)
+    def horizontal(line):
+        prefix = [0, *accumulate(line[col] for col in columns)]
+        return line, list(map(sub, prefix[kernel_size:], prefix[:width]))
 
-def edges(image):
-    ''' 
-        Edge Detection using Sobel operator
-        Returns an edge mask where 255 white represents an edge. 
-    '''
-    sobel_kernel_first = {'height': 3, 'width': 3, 'pixels':
-                          [
-                              -1,-2,-1,
-                              0,0,0,
-                              1,2,1
-                          ]}
-    
-    sobel_kernel_second = {'height': 3, 'width': 3, 'pixels':
-                        [
-                            -1,0,1,
-                            -2,0,2,
-                            -1,0,1
-                        ]}
-    
-    result = {'height':image['height'], 'width':image['width'], 'pixels': [] }
-    
-    result_first = correlate(image, sobel_kernel_first, 'extend')
-    result_second = correlate(image, sobel_kernel_second, 'extend')
-
-    for i, j in zip(result_first['pixels'], result_second['pixels']):
-        result['pixels'].append(math.sqrt((i**2) + (j**2)))
-        
-    result = round_and_clip_image(result)
+    # Slide a vertical window of kernel_size rows down the image
+    rows = iter(rows)
+    loaded = [horizontal(next(rows)) for _ in range(min(after + 1, height))]
+    window = deque(loaded[min(max(row, 0), height - 1)]
+                   for row in range(before * -1, after + 1))
+    total = [0] * width
+    for _, sums in window:
+        total = list(map(add, total, sums))
+
+    for row in range(height):
+        yield window[before][0], total
+        if row + 1 < height:
+            if row + after + 1 < height:
+                entering = horizontal(next(rows))
+            else:
+                entering = window[-1]
+            window.append(entering)
+            leaving = window.popleft()
+            total = list(map(sub, map(add, total, entering[1]), leaving[1]))
+
+
+def box_sums(image, kernel_size):
+    """
+    Returns an image whose pixels are the integer sums of every
+    (kernel_size x kernel_size) window, using "extend" edges.
+
+    Uses running sums along each row and then down each column, so the cost
+    per pixel does not depend on kernel_size. Even windows reach one pixel
+    less after the center than before, as in correlate. Float pixels give
+    float sums.
+    """
+    result = FloatImage(image['height'], image['width'], array('q'))
+    for _, total in _box_sum_rows(_image_rows(image), image['height'], image['width'],
+                                  kernel_size):
+        try:
+            result.pixels.extend(total)
+        except TypeError:
+            result.pixels = array('d', result.pixels)
+            result.pixels.extend(total)
     return result
 
-# HELPER FUNCTIONS FOR LOADING AND SAVING IMAGES
 
-def load_greyscale_image(filename):
+def _rounded_quotients(totals, divisor):
     """
-    Loads an image from the given file and returns a dictionary
-    representing that image.  This also performs conversion to greyscale.
+    Returns round(total / divisor) for each integer total, computed exactly
+    with integer arithmetic; halves round to even, as round() does.
+    """
+    if divisor == 1:
+        return list(totals)
+    if divisor % 2:
+        # An odd divisor never leaves a remainder of exactly one half
+        return [(2 * total + divisor) // (2 * divisor) for total in totals]
+    half = divisor // 2
+    result = []
+    for total in totals:
+        quotient, remainder = divmod(total, divisor)
+        rounds_up = remainder > half or (remainder == half and quotient & 1)
+        result.append(quotient + rounds_up)
+    return result
 
-    Invoked as, for example:
-       i = load_greyscale_image("test_images/cat.png")
+
+def _clip_values(values):
     """
-    with open(filename, "rb") as img_handle:
-        img = Image.open(img_handle)
-        img_data = img.getdata()
-        if img.mode.startswith("RGB"):
-            pixels = [round(.299 * p[0] + .587 * p[1] + .114 * p[2])
-                      for p in img_data]
-        elif img.mode == "LA":
-            pixels = [p[0] for p in img_data]
-        elif img.mode == "L":
-            pixels = list(img_data)
-        else:
-            raise ValueError(f"Unsupported image mode: {img.mode}")
-        width, height = img.size
-        return {"height": height, "width": width, "pixels": pixels}
+    Clips a sequence of integers into a bytearray.
+    """
+    return bytearray([0 if value < 0 else 255 if value > 255 else value
+                      for value in values])
 
 
-def save_greyscale_image(image, filename, mode="PNG"):
+def _fixed_point_values(totals, divisor):
     """
-    Saves the given image to disk or to a file-like object.  If filename is
-    given as a string, the file type will be inferred from the given name.  If
-    filename is given as a file-like object, the file type will be determined
-    by the "mode" parameter.
+    Turns integer kernel sums into 8-bit pixels: divides by the kernel's
+    scale with one exact rounding division, then clips. Gives the same
+    pixels as summing the float weights weight / divisor and calling
+    round_and_clip_image, without a float multiply per tap.
     """
-    out = Image.new(mode="L", size=(image["width"], image["height"]))
-    out.putdata(image["pixels"])
-    if isinstance(filename, str):
-        out.save(filename)
-    else:
-        out.save(filename, mode)
-    out.close()
+    return _clip_values(_rounded_quotients(totals, divisor))
+
+
+def _scaled_values(totals, divisor):
+    """
+    _fixed_point_values, except that float sums (from float pixels, such as
+    a float intermediate) are divided and rounded as floats.
+    """
+    try:
+        return _fixed_point_values(totals, divisor)
+    except TypeError:
+        return _round_and_clip_values([total / divisor for total in totals])
+
+
+# Largest Gx**2 + Gy**2 the Sobel kernels give on 8-bit pixels
+SOBEL_MAX_SQUARE = 2 * 1020 ** 2
+
+
+@functools.cache
+def sqrt_table():
+    """
+    Returns round(sqrt(n)) clipped to 255 for every n up to SOBEL_MAX_SQUARE,
+    as bytes. Exactly the n in [r*r - r + 1, r*r + r] round to r, since
+    (r + 1/2)**2 is never an integer, so the table matches rounding the
+    float square root.
+    """
+    runs = [b'\x00'] + [bytes([root]) * (2 * root) for root in range(1, 255)]
+    table = b''.join(runs)
+    return table + b'\xff' * (SOBEL_MAX_SQUARE + 1 - len(table))
+
+
+def _sobel_magnitudes(first, second):
+    """
+    Returns round(sqrt(x**2 + y**2)), clipped to 255, for gradient pairs.
+    """
+    squares = list(map(add, map(mul, first, first), map(mul, second, second)))
+    try:
+        return bytearray(map(sqrt_table().__getitem__, squares))
+    except (IndexError, TypeError):
+        # Gradients of pixels beyond 8 bits, or of float pixels
+        return bytearray([min(255, round(math.sqrt(square))) for square in squares])
+
+
+# PARALLEL EXECUTION
+
+def _typed_pixels(pixels):
+    """
+    Returns (typecode, buffer) for a pixel sequence: 'B' for 8-bit data,
+    otherwise the array typecode, packing plain lists as needed.
+    """
+    if isinstance(pixels, (bytes, bytearray)):
+        return 'B', pixels
+    if isinstance(pixels, memoryview):
+        return pixels.format, pixels
+    if isinstance(pixels, array):
+        return pixels.typecode, pixels
+    try:
+        return 'B', bytes(pixels)
+    except (TypeError, ValueError):
+        packed = FloatImage.from_values(0, 0, pixels).pixels
+        return packed.typecode, packed
+
+
+def _correlate_band(task):
+    """
+    Process pool worker: correlates output rows [row_start, row_stop) from the
+    shared input buffer into the shared output buffer. The band's halo rows
+    are read straight from the shared input through the edge mode.
+    """
+    (in_name, in_typecode, out_name, out_typecode, height, width,
+     growth, start, taps, boundary_behavior, row_start, row_stop) = task
+    source = shared_memory.SharedMemory(name=in_name)
+    target = shared_memory.SharedMemory(name=out_name)
+    try:
+        size = height * width
+        pixels = source.buf[:size * array(in_typecode).itemsize].cast(in_typecode)
+        values = _correlate_rows(_row_reader(pixels, width), height, width, growth,
+                                 start, taps, boundary_behavior, row_start, row_stop)
+        out = target.buf[:size * array(out_typecode).itemsize].cast(out_typecode)
+        out[row_start * width:row_stop * width] = array(out_typecode, values)
+        out.release()
+        pixels.release()
+    finally:
+        source.close()
+        target.close()
+
+
+def correlate_parallel(image, kernel, boundary_behavior, workers=None):
+    """
+    Same result as correlate, computed by a pool of `workers` processes
+    (default: one per CPU) on bands of rows.
+
+    The input and output pixels live in multiprocessing.shared_memory blocks,
+    so only band coordinates and the kernel are sent to each worker.
+    """
+    if boundary_behavior not in ['zero', 'wrap', 'extend']:
+        return None
+    workers = workers or os.cpu_count() or 1
+    height, width = image['height'], image['width']
+    growth, start, taps = _kernel_taps(kernel)
+
+    in_typecode, pixels = _typed_pixels(image['pixels'])
+    out_typecode = 'd' if isinstance(start, float) or in_typecode in 'fd' else 'q'
+    in_size = max(1, height * width * array(in_typecode).itemsize)
+    out_size = max(1, height * width * array(out_typecode).itemsize)
+
+    # A few more bands than workers keeps every process busy until the end
+    bands = max(1, min(height, workers * 4))
+    bounds = [height * band // bands for band in range(bands + 1)]
+
+    source = shared_memory.SharedMemory(create=True, size=in_size)
+    target = shared_memory.SharedMemory(create=True, size=out_size)
+    try:
+        data = memoryview(pixels).cast('B')
+        source.buf[:len(data)] = data
+        data.release()
+        tasks = [(source.name, in_typecode, target.name, out_typecode, height, width,
+                  growth, start, taps, boundary_behavior,
+                  bounds[band], bounds[band + 1])
+                 for band in range(bands) if bounds[band] < bounds[band + 1]]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_correlate_band, tasks))
+        result = array(out_typecode)
+        result.frombytes(target.buf[:height * width * result.itemsize])
+    finally:
+        source.close()
+        source.unlink()
+        target.close()
+        target.unlink()
+
+    return FloatImage(height, width, result)
+
+
+# CORRELATION STRATEGIES
+
+# Relative cost of one kernel tap on one pixel in the direct method, and of
+# one butterfly on one pixel in the FFT, as measured on CPython
+DIRECT_TAP_COST = 1.0
+FFT_BUTTERFLY_COST = 1.7
+
+# Largest FFT block side: the pure-Python transform holds every point as a
+# complex object (about 200 bytes), so larger images are done in tiles
+FFT_BLOCK = 256
+
+# Float results of the separable and FFT methods stay within this fraction
+# of sum(|kernel|) * max(|pixel|) of the direct sums
+FLOAT_TOLERANCE = 1e-12
+
+
+# Most rank 1 terms kernel_plan looks for; each costs an elimination step
+# over the whole kernel in exact fractions
+MAX_KERNEL_TERMS = 8
+
+
+def _term_limit(height, width):
+    return min(MAX_KERNEL_TERMS, height * width // (height + width))
+
+
+def _exceeds_term_limit(height, width, values):
+    """
+    Quick float elimination: True if the kernel is clearly not within the
+    term limit, sparing the exact elimination on large dense kernels.
+    """
+    residual = [float(value) for value in values]
+    limit = FLOAT_TOLERANCE * max(map(abs, residual), default=0)
+    for _ in range(_term_limit(height, width) + 1):
+        pivot_index = max(range(height * width), key=lambda index: abs(residual[index]))
+        pivot = residual[pivot_index]
+        if abs(pivot) <= limit:
+            return False
+        pivot_row, pivot_col = divmod(pivot_index, width)
+        row = residual[pivot_row * width:(pivot_row + 1) * width]
+        for line in range(height):
+            weight = residual[line * width + pivot_col] / pivot
+            if weight:
+                span = slice(line * width, (line + 1) * width)
+                residual[span] = [value - weight * factor
+                                  for value, factor in zip(residual[span], row)]
+    return True
+
+
+def _exact_terms(height, width, values):
+    """
+    Splits a kernel into the fewest rank 1 terms (column, row), with the
+    kernel the sum of their outer products, by Gaussian elimination on
+    exact fractions; floats convert to fractions exactly too. Returns None
+    past MAX_KERNEL_TERMS terms, or past height * width // (height + width)
+    where the row and column passes would need more taps than the kernel.
+    """
+    residual = [[Fraction(value) for value in values[row * width:(row + 1) * width]]
+                for row in range(height)]
+    terms = []
+    while True:
+        pivot_row, pivot_col = max(((row, col) for row in range(height)
+                                    for col in range(width)),
+                                   key=lambda index: abs(residual[index[0]][index[1]]))
+        pivot = residual[pivot_row][pivot_col]
+        if pivot == 0:
+            return terms
+        if len(terms) == _term_limit(height, width):
+            return None
+        column = [line[pivot_col] / pivot for line in residual]
+        row = list(residual[pivot_row])
+        terms.append((column, row))
+        residual = [[value - weight * factor for value, factor in zip(line, row)]
+                    for line, weight in zip(residual, column)]
+
+
+def _integer_vector(values):
+    """
+    Returns (factor, integers) with values == factor * integers, the
+    integers sharing no common divisor.
+    """
+    denominator = math.lcm(*(value.denominator for value in values))
+    integers = [int(value * denominator) for value in values]
+    divisor = math.gcd(*integers)
+    return Fraction(divisor, denominator), [value // divisor for value in integers]
+
+
+def _approximate_factors(height, width, values):
+    """
+    Returns (column, row) float weights whose outer product is within
+    FLOAT_TOLERANCE of a float kernel, or None if it is not that close to
+    rank 1. Catches kernels such as a Gaussian built from rounded products,
+    which are rank 1 only up to rounding.
+    """
+    pivot_index = max(range(height * width), key=lambda index: abs(values[index]))
+    pivot = values[pivot_index]
+    if pivot == 0:
+        return None
+    pivot_row, pivot_col = divmod(pivot_index, width)
+    row = list(values[pivot_row * width:(pivot_row + 1) * width])
+    column = [values[index * width + pivot_col] / pivot for index in range(height)]
+    limit = FLOAT_TOLERANCE * abs(pivot)
+    for index, value in enumerate(values):
+        if abs(column[index // width] * row[index % width] - value) > limit:
+            return None
+    return column, row
+
+
+@functools.lru_cache(maxsize=256)
+def _compiled_plan(height, width, values, integer):
+    try:
+        terms = None
+        if not _exceeds_term_limit(height, width, values):
+            terms = _exact_terms(height, width, values)
+    except (ValueError, OverflowError):
+        # Infinite or NaN weights run dense
+        return None
+    if terms == []:
+        # All zero
+        return None
+    if terms is None:
+        factors = None if integer else _approximate_factors(height, width, values)
+        if factors is None:
+            return None
+        scale, terms = 1, [factors]
+    else:
+        # Each term as factor * (integer column x integer row)
+        vectors = []
+        for column, row in terms:
+            column_factor, column = _integer_vector(column)
+            row_factor, row = _integer_vector(row)
+            vectors.append((column_factor * row_factor, column, row))
+        if integer:
+            # kernel == sum(column x row) / scale, all in integers
+            scale = math.lcm(*(factor.denominator for factor, _, _ in vectors))
+            terms = [([value * factor.numerator * (scale // factor.denominator)
+                       for value in column], row) for factor, column, row in vectors]
+        else:
+            scale = 1
+            terms = [([float(value * factor) for value in column], row)
+                     for factor, column, row in vectors]
+
+    passes = []
+    for column, row in terms:
+        passes.append((_kernel_taps({'height': 1, 'width': width, 'pixels': row}),
+                       _kernel_taps({'height': height, 'width': 1, 'pixels': column})))
+    return {'scale': scale, 'terms': terms, 'passes': passes}
+
+
+def kernel_plan(kernel):
+    """
+    Analyses a kernel for correlate's separable method. Returns None for a
+    kernel that must run dense, else a dict with 'terms', a list of
+    (column, row) weights, and 'scale', such that the kernel is the sum of
+    the terms' outer products divided by scale; 'passes' holds the taps of
+    each term's row pass and column pass.
+
+    The terms come from exact rational elimination, so a box, Sobel or other
+    rank 1 kernel gives one term and an unsharp mask (centre minus box) two.
+    Integer kernels get integer terms, keeping every sum exact. Float
+    kernels that are only rank 1 up to rounding are split within
+    FLOAT_TOLERANCE. Plans are memoized by kernel content and shared, so do
+    not modify them.
+    """
+    values = tuple(kernel['pixels'])
+    integer = all(isinstance(value, int) for value in values)
+    return _compiled_plan(kernel['height'], kernel['width'], values, integer)
+
+
+def _next_power_of_two(size):
+    return 1 << max(0, size - 1).bit_length()
+
+
+def _fft_tiling(size, growth):
+    """
+    Returns (tile, fft size) along one side: output tiles of `tile` pixels,
+    each transformed with its 2 * growth border at `fft size`, a power of two
+    of at most FFT_BLOCK unless the border alone needs more.
+    """
+    fft_size = _next_power_of_two(size + 2 * growth)
+    if fft_size > FFT_BLOCK:
+        fft_size = max(FFT_BLOCK, _next_power_of_two(4 * growth))
+    return fft_size - 2 * growth, fft_size
+
+
+def correlation_costs(height, width, kernel):
+    """
+    Returns the estimated cost of each way correlate can run a kernel over a
+    (height x width) image: {'direct': ..., 'separable': ..., 'fft': ...}.
+    'separable' is left out for kernels that kernel_plan cannot split.
+    """
+    growth, _, taps = _kernel_taps(kernel)
+    padded = (height + 2 * growth) * (width + 2 * growth)
+    costs = {'direct': DIRECT_TAP_COST * (padded + height * width * len(taps))}
+    plan = kernel_plan(kernel)
+    if plan is not None:
+        costs['separable'] = DIRECT_TAP_COST * sum(
+            2 * padded + height * width * (len(row_taps[2]) + len(column_taps[2]) + 1)
+            for row_taps, column_taps in plan['passes'])
+    tile_height, fft_height = _fft_tiling(height, growth)
+    tile_width, fft_width = _fft_tiling(width, growth)
+    tiles = -(-height // tile_height) * -(-width // tile_width)
+    # Forward and inverse transforms of every tile, and one of the kernel
+    butterflies = (fft_height * fft_width
+                   * (fft_height.bit_length() + fft_width.bit_length()))
+    costs['fft'] = FFT_BUTTERFLY_COST * (2 * tiles + 1) * butterflies / 2
+    return costs
+
+
+def correlation_method(height, width, kernel):
+    """
+    Returns the cheapest correlate method for a kernel over a
+    (height x width) image: "direct", "separable" or "fft".
+    """
+    costs = correlation_costs(height, width, kernel)
+    return min(costs, key=costs.get)
+
+
+def _direct_value(image, row, col, start, taps, boundary_behavior):
+    """
+    One pixel of the direct method, summed in the same order.
+    """
+    total = start
+    for y_offset, x_offset, value in taps:
+        total = total + value * get_pixel_mode(image, row + y_offset, col + x_offset,
+                                               boundary_behavior)
+    return total
+
+
+def _correlate_separable(image, kernel, boundary_behavior):
+    """
+    Correlates with a kernel split by kernel_plan: each term runs as a pass
+    along each row followed by a pass down each column, and the terms are
+    summed. Every edge mode treats rows and columns independently, so the
+    two passes see the same borders as the full kernel.
+
+    Integer plans on integer pixels are exact. With float weights or float
+    pixels, the few sums close enough to a half that rounding could tell
+    them apart from the direct method's are recomputed as the direct method
+    does, so both round and clip alike.
+    """
+    plan = kernel_plan(kernel)
+    if plan is None:
+        raise ValueError("Kernel is not separable")
+    height, width, pixels = image['height'], image['width'], image['pixels']
+    totals = None
+    for row_taps, column_taps in plan['passes']:
+        values = pixels
+        for growth, start, taps in (row_taps, column_taps):
+            values = _correlate_rows(_row_reader(values, width), height, width, growth,
+                                     start, taps, boundary_behavior)
+        totals = values if totals is None else list(map(add, totals, values))
+    integral = _typed_pixels(pixels)[0] not in 'fd'
+    if plan['scale'] != 1:
+        scale = plan['scale']
+        if integral:
+            # Integer kernel and pixels: every total is an exact multiple of the scale
+            totals = [total // scale for total in totals]
+        else:
+            totals = [total / scale for total in totals]
+
+    _, start, taps = _kernel_taps(kernel)
+    if isinstance(start, float) or not integral:
+        # Both methods are within FLOAT_TOLERANCE of the exact sums
+        margin = (2 * FLOAT_TOLERANCE * sum(abs(value) for _, _, value in taps)
+                  * max(map(abs, pixels), default=0))
+        for index, total in enumerate(totals):
+            if abs(total % 1 - 0.5) <= margin:
+                totals[index] = _direct_value(image, *divmod(index, width), start, taps,
+                                              boundary_behavior)
+    return FloatImage.from_values(height, width, totals)
+
+
+def _fft_rows(rows, inverse=False):
+    """
+    Transforms a list of equal-length rows in place down the columns: a
+    radix-2 FFT whose butterflies combine whole rows, so the work runs in
+    C-level loops along each row. len(rows) must be a power of two. The
+    inverse transform is left unscaled.
+    """
+    size = len(rows)
+    bits = size.bit_length() - 1
+    for index in range(size):
+        reverse = int(format(index, f'0{bits}b')[::-1], 2) if bits else 0
+        if index < reverse:
+            rows[index], rows[reverse] = rows[reverse], rows[index]
+    sign = 1 if inverse else -1
+    span = 1
+    while span < size:
+        factors = [cmath.exp(sign * 1j * math.pi * k / span) for k in range(span)]
+        for first in range(0, size, 2 * span):
+            for k in range(span):
+                top, bottom = rows[first + k], rows[first + k + span]
+                if k:
+                    factor = factors[k]
+                    bottom = [factor * value for value in bottom]
+                rows[first + k] = list(map(add, top, bottom))
+                rows[first + k + span] = list(map(sub, top, bottom))
+        span *= 2
+    return rows
+
+
+def _fft_2d(rows, inverse=False):
+    """
+    Returns the 2D transform of a list of rows, transposed.
+    """
+    return _fft_rows(list(zip(*_fft_rows(rows, inverse))), inverse)
+
+
+def _correlate_fft(image, kernel, boundary_behavior):
+    """
+    Correlates through the FFT, tile by tile (overlap-save) so that memory
+    stays bounded by FFT_BLOCK. Each output tile is padded with its border
+    for the edge mode, just as the direct method pads the image, then
+    zero-filled to the power-of-two block; every output only reads inside
+    the padded tile, so the circular correlation never wraps into the zero
+    fill.
+
+    Integer kernels on integer pixels give exact results: the sums are
+    rounded back to integers. Float results stay within FLOAT_TOLERANCE.
+    """
+    height, width = image['height'], image['width']
+    growth, start, taps = _kernel_taps(kernel)
+    tile_height, fft_height = _fft_tiling(height, growth)
+    tile_width, fft_width = _fft_tiling(width, growth)
+
+    # Multiplying by the conjugate of the kernel's transform sums tap
+    # (y, x) times pixel (row + y, col + x) into (row, col)
+    kernel_rows = [[0] * fft_width for _ in range(fft_height)]
+    for y_offset, x_offset, value in taps:
+        kernel_rows[y_offset % fft_height][x_offset % fft_width] = value
+    weights = [[weight.conjugate() for weight in line] for line in _fft_2d(kernel_rows)]
+    del kernel_rows
+
+    scale = fft_height * fft_width
+    exact = isinstance(start, int) and _typed_pixels(image['pixels'])[0] not in 'fd'
+    result_pixels = [start] * (height * width)
+    for top in range(0, height, tile_height):
+        bottom = min(height, top + tile_height)
+        for left in range(0, width, tile_width):
+            right = min(width, left + tile_width)
+            padded_width = right - left + 2 * growth
+            region = (left, top, right, bottom)
+            buffer = _pad_region(image, growth, boundary_behavior, region)
+            zero_fill = [0] * (fft_width - padded_width)
+            rows = [buffer[row:row + padded_width] + zero_fill
+                    for row in range(0, len(buffer), padded_width)]
+            rows += [[0] * fft_width for _ in range(fft_height - len(rows))]
+            spectrum = [list(map(mul, line, weight_line))
+                        for line, weight_line in zip(_fft_2d(rows), weights)]
+            rows = _fft_2d(spectrum, inverse=True)
+            for row, line in enumerate(rows[growth:growth + bottom - top], top):
+                values = [value.real / scale
+                          for value in line[growth:growth + right - left]]
+                if exact:
+                    values = [round(value) for value in values]
+                result_pixels[row * width + left:row * width + right] = values
+    return FloatImage.from_values(height, width, result_pixels)
+
+
+# FILTERS
+
+SOBEL_KERNEL_FIRST = {'height': 3, 'width': 3, 'pixels':
+                      [
+                          -1,-2,-1,
+                          0,0,0,
+                          1,2,1
+                      ]}
+
+SOBEL_KERNEL_SECOND = {'height': 3, 'width': 3, 'pixels':
+                       [
+                           -1,0,1,
+                           -2,0,2,
+                           -1,0,1
+                       ]}
+
+def _filter_into(name, kernel_size, image, out):
+    """
+    Runs a row filter over an image, writing each finished row into out.
+    Rows are read only as far as the kernel reaches and kept as copies, so
+    out may be image itself.
+    """
+    _check_out(image, out)
+    width = image['width']
+    rows = row_filter(name, kernel_size)(_image_rows(image), image['height'], width)
+    for row, line in enumerate(rows):
+        out['pixels'][row * width:(row + 1) * width] = line
+    return out
+
+
+@_planar
+@_instrumented('blurred', _pixel_counter)
+def blurred(image, kernel_size, out=None):
+    """
+    Returns a new image representing the result of applying a box blur (with the
+    given kernel size) to the given input image.
+
+    Sums the integer pixels of each window, then divides by the window area
+    once per pixel. Running box sums keep the cost from growing with
+    kernel_size.
+    With out (a GreyscaleImage of the same size, possibly image itself) the
+    result is written into it a row at a time and out is returned.
+    """
+    if out is not None:
+        return _filter_into('blur', kernel_size, image, out)
+    area = kernel_size ** 2
+    totals = box_sums(image, kernel_size)['pixels']
+    return GreyscaleImage(image['height'], image['width'], _scaled_values(totals, area))
+
+@_planar
+@_instrumented('sharpened', _pixel_counter)
+def sharpened(image, kernel_size, out=None):
+    """
+    Sharpening Formula: S(r,c) = 2*I(r,c) - Blur(r,c) = - Blur(r,c) + 2*I(r,c)
+    Returns a new image representing the result of applying an unsharp mask (with the
+    given kernel size) to the given input image.
+
+    Works in integers scaled by the window area, like blurred: each pixel is
+    (2 * area * I(r,c) - window sum) / area, divided once, with running box
+    sums. out works as for blurred.
+    """
+    if out is not None:
+        return _filter_into('sharpen', kernel_size, image, out)
+    area = kernel_size ** 2
+    totals = [2 * area * pixel - total for pixel, total
+              in zip(image['pixels'], box_sums(image, kernel_size)['pixels'])]
+    return GreyscaleImage(image['height'], image['width'], _scaled_values(totals, area))
+
+def _sobel_gradients(rows, height):
+    """
+    Yields (Gx, Gy) for each row of an image, with "extend" edges, reading
+    each source row once.
+
+    Both Sobel kernels are separable, so each row works from its padded
+    neighbours: Gx differences the vertically smoothed row p + 2c + n
+    two columns apart, and Gy smooths the vertical difference n - p along
+    the row.
+    """
+    # Rows of mapped images are memoryviews, which do not concatenate
+    rows = ((bytes(line) if line.format == 'B' else line.tolist())
+            if isinstance(line, memoryview) else line for line in rows)
+    above = line = None
+    for row in range(height):
+        if line is None:
+            line = next(rows)
+            line = line[:1] + line + line[-1:]
+            above = line
+        below = next(rows) if row + 1 < height else None
+        if below is not None:
+            below = below[:1] + below + below[-1:]
+        else:
+            below = line
+        smooth = list(map(add, map(add, above, line), map(add, line, below)))
+        change = list(map(sub, below, above))
+        middle = change[1:-1]
+        yield (list(map(sub, smooth[2:], smooth[:-2])),
+               list(map(add, map(add, change[:-2], change[2:]),
+                        map(add, middle, middle))))
+        above, line = line, below
+
+
+# Approximate magnitude |Gx| + |Gy|, clipped
+L1_TABLE = bytes(min(255, value) for value in range(4 * 1020 + 1))
+
+
+def _edge_rows(rows, height, magnitude='euclidean', threshold=None, directions=None):
+    """
+    Yields the edge magnitudes of each row as bytes, from one pass of
+    _sobel_gradients. With a threshold, magnitudes of at least `threshold`
+    become 255 and the rest 0, folded into the same table lookup. If
+    directions is a list, each row's gradient directions are appended to it.
+    """
+    if magnitude == 'euclidean':
+        table = sqrt_table()
+    elif magnitude == 'l1':
+        table = L1_TABLE
+    else:
+        raise ValueError(f"Unknown magnitude: {magnitude!r}")
+    if threshold is not None:
+        table = table.translate(threshold_table(threshold))
+    lookup = table.__getitem__
+    for x_gradients, y_gradients in _sobel_gradients(rows, height):
+        if magnitude == 'euclidean':
+            values = list(map(add, map(mul, x_gradients, x_gradients),
+                              map(mul, y_gradients, y_gradients)))
+        else:
+            values = list(map(add, map(abs, x_gradients), map(abs, y_gradients)))
+        try:
+            yield bytes(map(lookup, values))
+        except (IndexError, TypeError):
+            # Wide or float pixels have gradients beyond the tables
+            if magnitude == 'euclidean':
+                line = _sobel_magnitudes(x_gradients, y_gradients)
+            else:
+                line = bytearray([min(255, round(value)) for value in values])
+            if threshold is not None:
+                line = line.translate(threshold_table(threshold))
+            yield bytes(line)
+        if directions is not None:
+            directions.append(_gradient_directions(x_gradients, y_gradients))
+
+
+def _gradient_directions(x_gradients, y_gradients):
+    """
+    Returns the direction of each gradient, atan2(Gy, Gx), as a byte in
+    256ths of a turn from +x towards +y: 0 points right and 64 down, since
+    rows grow downwards.
+    """
+    scale = 128 / math.pi
+    return bytes([round(angle * scale) & 255
+                  for angle in map(math.atan2, y_gradients, x_gradients)])
+
+
+@_planar
+@_instrumented('edges', _pixel_counter)
+def edges(image, out=None, threshold=None, direction=False, magnitude='euclidean'):
+    ''' 
+        Edge Detection using Sobel operator
+        Returns an edge mask where 255 white represents an edge. 
+
+    Gx, Gy and the clipped magnitude come out of one fused pass that reads
+    each row once (see _sobel_gradients); the magnitude is a lookup in
+    sqrt_table, so results match round(sqrt(Gx**2 + Gy**2)) exactly.
+
+    magnitude="l1" uses |Gx| + |Gy| instead, a cheaper approximation. With a
+    threshold the result is binary: 255 where the magnitude is at least
+    `threshold`, else 0. direction=True returns (edges, directions), where
+    directions holds each gradient's angle in 256ths of a turn (see
+    _gradient_directions). out works as for blurred.
+    '''
+    height, width = image['height'], image['width']
+    directions = [] if direction else None
+    rows = _edge_rows(_image_rows(image), height, magnitude, threshold, directions)
+    if out is not None:
+        _check_out(image, out)
+        for row, line in enumerate(rows):
+            out['pixels'][row * width:(row + 1) * width] = line
+        result = out
+    else:
+        result = GreyscaleImage(height, width, bytearray(b''.join(rows)))
+    if direction:
+        return result, GreyscaleImage(height, width, bytearray(b''.join(directions)))
+    return result
+
+# RANK FILTERS
+
+# Largest kernel size for which sorting each window beats the sliding
+# histogram on CPython; the sort runs in C but grows with kernel_size ** 2
+RANK_SORT_MAX_SIZE = 3
+
+
+def _histogram_ranks(lines, width, kernel_size, rank):
+    """
+    Returns the rank-th smallest value of each (kernel_size x kernel_size)
+    window along one row of 8-bit pixels, using Huang's sliding histogram.
+
+    A 256-bin histogram of the window is updated as the window moves one
+    column right: the leaving column is removed and the entering column
+    added, O(kernel_size) per pixel. The answer is tracked with a running
+    count of window values below it, so it moves only as far as the
+    window's values change.
+    """
+    columns = list(zip(*lines))
+    histogram = [0] * 256
+    for column in columns[:kernel_size]:
+        for color in column:
+            histogram[color] += 1
+    value = below = 0
+    result = bytearray(width)
+    for col in range(width):
+        while below > rank:
+            value -= 1
+            below -= histogram[value]
+        while below + histogram[value] <= rank:
+            below += histogram[value]
+            value += 1
+        result[col] = value
+        if col + 1 < width:
+            for color in columns[col]:
+                histogram[color] -= 1
+                if color < value:
+                    below -= 1
+            for color in columns[col + kernel_size]:
+                histogram[color] += 1
+                if color < value:
+                    below += 1
+    return result
+
+
+def _rank_line(lines, width, kernel_size, rank, method):
+    """
+    Returns one output row of a rank filter from the kernel_size padded
+    source rows around it.
+    """
+    if kernel_size == 1:
+        return lines[0][:width]
+    if method == 'separable':
+        # Window extremes are the extremes of the column extremes
+        extreme = min if rank == 0 else max
+        vertical = list(map(extreme, *lines))
+        return list(map(extreme, *(vertical[col:col + width]
+                                   for col in range(kernel_size))))
+    if method == 'histogram':
+        return _histogram_ranks(lines, width, kernel_size, rank)
+    columns = list(zip(*lines))
+    return [sorted(chain.from_iterable(columns[col:col + kernel_size]))[rank]
+            for col in range(width)]
+
+
+def _rank_method(pixels, kernel_size, rank, method):
+    extremes = (0, kernel_size ** 2 - 1)
+    if method == 'auto':
+        if rank in extremes:
+            return 'separable'
+        if kernel_size <= RANK_SORT_MAX_SIZE or _typed_pixels(pixels)[0] != 'B':
+            return 'sort'
+        return 'histogram'
+    if method == 'separable' and rank not in extremes:
+        raise ValueError("The separable method only finds window minima and maxima")
+    if method == 'histogram' and _typed_pixels(pixels)[0] != 'B':
+        raise ValueError("The histogram method needs 8-bit pixels")
+    if method not in ('separable', 'histogram', 'sort'):
+        raise ValueError(f"Unknown rank filter method: {method!r}")
+    return method
+
+
+def _rank_row(read_row, height, width, kernel_size, rank, boundary_behavior, method,
+              row):
+    """
+    Returns one output row of a rank filter, padding the kernel_size source
+    rows around it.
+    """
+    growth = kernel_size // 2
+    padded_width = width + 2 * growth
+    buffer = _pad_rows(read_row, height, width, growth, boundary_behavior, row, row + 1)
+    lines = [buffer[line * padded_width:(line + 1) * padded_width]
+             for line in range(kernel_size)]
+    return _rank_line(lines, width, kernel_size, rank, method)
+
+
+@_planar
+@_instrumented('rank', _pixel_counter)
+def rank_filtered(image, kernel_size, rank, boundary_behavior='extend', method='auto',
+                  out=None):
+    """
+    Returns a new image where each pixel is the rank-th smallest (from 0) of
+    the (kernel_size x kernel_size) window around it, reading beyond the
+    edges with the modes of get_pixel_mode ("zero", "wrap" or "extend").
+
+    method picks how windows are ranked: "histogram" slides Huang's 256-bin
+    histogram along each row (8-bit images only), "sort" sorts every window,
+    and "separable" (minimum and maximum only) takes column extremes, then
+    row extremes. "auto" takes "separable" where it applies, else sorts
+    small kernels and uses the histogram beyond RANK_SORT_MAX_SIZE. out
+    works as for blurred. As with correlate, an unknown boundary_behavior
+    returns None.
+    """
+    if boundary_behavior not in ['zero', 'wrap', 'extend']:
+        return None
+    if kernel_size < 1 or not 0 <= rank < kernel_size ** 2:
+        raise ValueError(f"Rank must be between 0 and {kernel_size ** 2 - 1}")
+    height, width, pixels = image['height'], image['width'], image['pixels']
+    method = _rank_method(pixels, kernel_size, rank, method)
+    read_row = _row_reader(pixels, width)
+    rows = (_rank_row(read_row, height, width, kernel_size, rank, boundary_behavior,
+                      method, row)
+            for row in range(height))
+    if out is not None:
+        _check_out(image, out)
+        # Every source row is copied out before the first write
+        rows = list(rows)
+        for row, line in enumerate(rows):
+            _store(out, row * width, line)
+        return out
+    values = list(chain.from_iterable(rows))
+    try:
+        return GreyscaleImage(height, width, bytearray(values))
+    except (TypeError, ValueError):
+        return FloatImage.from_values(height, width, values)
+
+
+def percentile_filtered(image, kernel_size, percentile, boundary_behavior='extend',
+                        method='auto', out=None):
+    """
+    Rank filter picking the given percentile (0 to 100) of each window: the
+    value at position round(percentile / 100 * (kernel_size ** 2 - 1)) of
+    the sorted window.
+    """
+    if not 0 <= percentile <= 100:
+        raise ValueError("Percentile must be between 0 and 100")
+    rank = round(percentile / 100 * (kernel_size ** 2 - 1))
+    return rank_filtered(image, kernel_size, rank, boundary_behavior, method, out)
+
+
+def median_filtered(image, kernel_size, boundary_behavior='extend', method='auto',
+                    out=None):
+    """
+    Median filter, for removing salt-and-pepper noise. Even windows take the
+    upper of their two middle values.
+    """
+    return rank_filtered(image, kernel_size, kernel_size ** 2 // 2, boundary_behavior,
+                         method, out)
+
+
+def min_filtered(image, kernel_size, boundary_behavior='extend', out=None):
+    return rank_filtered(image, kernel_size, 0, boundary_behavior, out=out)
+
+
+def max_filtered(image, kernel_size, boundary_behavior='extend', out=None):
+    return rank_filtered(image, kernel_size, kernel_size ** 2 - 1, boundary_behavior,
+                         out=out)
+
+
+# STREAMING
+
+def _row_windows(rows, height, growth):
+    """
+    Yields, for each output row in order, a dict from source row to pixels
+    holding the rows within `growth` of it (clamped to the image). Rows are
+    read from the `rows` iterator only as far as needed.
+    """
+    rows = iter(rows)
+    window = {}
+    loaded = 0
+    for row in range(height):
+        while loaded <= min(row + growth, height - 1):
+            window[loaded] = next(rows)
+            loaded += 1
+        window.pop(row - growth - 1, None)
+        yield window
+
+
+def row_filter(name, kernel_size=None):
+    """
+    Returns a function apply(rows, height, width) that runs the filter `name`
+    ("invert", "blur", "sharpen", "edges" or "median") like filter_rows. The kernel and
+    its taps are built once here, so one row filter can be applied to any
+    number of images.
+    """
+    if name == 'invert':
+        def apply(rows, height, width):
+            for line in rows:
+                yield bytearray(line).translate(INVERT_TABLE)
+    elif name in ('blur', 'sharpen'):
+        area = kernel_size ** 2
+        def apply(rows, height, width):
+            for line, sums in _box_sum_rows(rows, height, width, kernel_size):
+                if name == 'blur':
+                    yield _fixed_point_values(sums, area)
+                else:
+                    totals = [2 * area * pixel - total
+                              for pixel, total in zip(line, sums)]
+                    yield _fixed_point_values(totals, area)
+    elif name == 'edges':
+        def apply(rows, height, width):
+            for line in _edge_rows(rows, height):
+                yield bytearray(line)
+    elif name == 'median':
+        rank = kernel_size ** 2 // 2
+        method = 'sort' if kernel_size <= RANK_SORT_MAX_SIZE else 'histogram'
+        def apply(rows, height, width):
+            for row, window in enumerate(_row_windows(rows, height, kernel_size // 2)):
+                yield bytearray(_rank_row(window.__getitem__, height, width,
+                                          kernel_size, rank, 'extend', method, row))
+    else:
+        raise ValueError(f"Unknown filter: {name}")
+    return apply
+
+
+def filter_rows(rows, height, width, name, kernel_size=None):
+    """
+    Applies the filter `name` ("invert", "blur", "sharpen", "edges" or
+    "median") to an iterator over the 8-bit rows of a (height x width) image,
+    yielding each output row as a bytearray as soon as it is finished.
+
+    At most kernel_size input rows are held at once, and the results match
+    the whole-image filters exactly.
+    """
+    return row_filter(name, kernel_size)(rows, height, width)
+
+
+# INCREMENTAL UPDATES
+
+def _spans(start, stop, size, boundary_behavior):
+    """
+    Returns the [start, stop) ranges of in-image indices covered by
+    [start, stop), which under "wrap" may come round from the far side.
+    """
+    if boundary_behavior == 'wrap':
+        if stop - start >= size:
+            return [(0, size)]
+        start, stop = start % size, stop % size or size
+        if start < stop:
+            return [(start, stop)]
+        return [(start, size), (0, stop)]
+    start, stop = max(0, start), min(size, stop)
+    return [(start, stop)] if start < stop else []
+
+
+def affected_regions(dirty, growth, height, width, boundary_behavior='extend'):
+    """
+    Returns the output rectangles that change when the input rectangles in
+    dirty change, for a kernel reaching `growth` pixels from its center.
+    Rectangles are (left, top, right, bottom), right and bottom exclusive.
+    Under "wrap" an edit near an edge also reaches the opposite edge, so a
+    rectangle can split into up to four.
+    """
+    regions = []
+    for left, top, right, bottom in dirty:
+        for row_start, row_stop in _spans(top - growth, bottom + growth, height,
+                                          boundary_behavior):
+            for col_start, col_stop in _spans(left - growth, right + growth, width,
+                                              boundary_behavior):
+                regions.append((col_start, row_start, col_stop, row_stop))
+    return regions
+
+
+def _pad_region(image, growth, boundary_behavior, region):
+    """
+    Returns a border buffer like _pad_rows, but holding only the columns and
+    rows of one output rectangle plus `growth` on every side.
+    """
+    height, width, pixels = image['height'], image['width'], image['pixels']
+    left, top, right, bottom = region
+    columns = [get_boundary_index(col, width, boundary_behavior)
+               for col in range(left - growth, right + growth)]
+    inside = left - growth >= 0 and right + growth <= width
+    buffer = []
+    for row in range(top - growth, bottom + growth):
+        source = get_boundary_index(row, height, boundary_behavior)
+        if source is None:
+            buffer.extend([0] * len(columns))
+        elif inside:
+            offset = source * width
+            buffer.extend(pixels[offset + left - growth:offset + right + growth])
+        else:
+            line = pixels[source * width:(source + 1) * width]
+            buffer.extend([0 if col is None else line[col] for col in columns])
+    return buffer
+
+
+def _patch(previous, region, values):
+    """
+    Writes the values of an output rectangle into the previous result.
+    """
+    left, top, right, bottom = region
+    width = previous['width']
+    span = right - left
+    for row in range(top, bottom):
+        start = (row - top) * span
+        _store(previous, row * width + left, values[start:start + span])
+
+
+def recorrelate_regions(image, kernel, boundary_behavior, previous, dirty):
+    """
+    Updates previous, an earlier correlate(image, kernel, boundary_behavior)
+    result, after the rectangles in dirty of image were edited, and returns
+    it. Only the dirty rectangles grown by the kernel radius are recomputed,
+    so the cost scales with the edited area; the patched pixels are
+    identical to correlating the whole image with the direct method.
+    """
+    if boundary_behavior not in ['zero', 'wrap', 'extend']:
+        return None
+    growth, start, taps = _kernel_taps(kernel)
+    for region in affected_regions(dirty, growth, image['height'], image['width'],
+                                   boundary_behavior):
+        buffer = _pad_region(image, growth, boundary_behavior, region)
+        left, top, right, bottom = region
+        _patch(previous, region, _correlate_padded(buffer, bottom - top, right - left,
+                                                   growth, start, taps))
+    return previous
+
+
+def recompute_regions(image, previous, dirty, name, kernel_size=None):
+    """
+    Updates previous, the earlier output of the filter `name` ("invert",
+    "blur", "sharpen" or "edges", as for filter_rows) on image, after the
+    rectangles in dirty of image were edited, and returns it. Only the dirty
+    rectangles grown by the kernel radius are recomputed, and the patched
+    pixels are identical to filtering the whole image again.
+
+    Invoked as, for example:
+       image_edited(image, rect)
+       recompute_regions(image, blurred_image, [rect], "blur", 7)
+    """
+    if name == 'invert':
+        kernels = [{'height': 1, 'width': 1, 'pixels': [-1]}]
+    elif name == 'blur':
+        kernels = [generate_kernel(kernel_size, 1)]
+    elif name == 'sharpen':
+        kernels = [sharpen_kernel(kernel_size)]
+    elif name == 'edges':
+        kernels = [SOBEL_KERNEL_FIRST, SOBEL_KERNEL_SECOND]
+    else:
+        raise ValueError(f"Unknown filter: {name}")
+    compiled = [_kernel_taps(kernel) for kernel in kernels]
+    growth = compiled[0][0]
+    for region in affected_regions(dirty, growth, image['height'], image['width']):
+        buffer = _pad_region(image, growth, 'extend', region)
+        left, top, right, bottom = region
+        sums = [_correlate_padded(buffer, bottom - top, right - left, growth, start,
+                                  taps)
+                for _, start, taps in compiled]
+        if name == 'invert':
+            values = [255 + total for total in sums[0]]
+        elif name == 'edges':
+            values = _sobel_magnitudes(sums[1], sums[0])
+        else:
+            values = _fixed_point_values(sums[0], kernel_size ** 2)
+        _patch(previous, region, values)
+    return previous
+
+
+# HELPER FUNCTIONS FOR LOADING AND SAVING IMAGES
+
+def _luminance(img):
+    """
+    Converts an RGB or RGBA PIL image to round(.299 * r + .587 * g + .114 * b)
+    per pixel, returning a bytearray.
+
+    The arithmetic runs in PIL's ImageMath on 32-bit integers: the weighted
+    sum in thousandths is exact, and away from a half the float formula
+    always rounds the same way. The few sums ending in exactly one half are
+    rounded with the float formula itself, so results match it bit for bit.
+    """
+    red, green, blue = img.split()[:3]
+    total = ImageMath.lambda_eval(lambda args: args['r'] * 299 + args['g'] * 587
+                                  + args['b'] * 114, r=red, g=green, b=blue)
+    pixels = bytearray(ImageMath.lambda_eval(lambda args: (args['total'] + 500) / 1000,
+                                             total=total).convert('L').tobytes())
+    halves = ImageMath.lambda_eval(lambda args: args['total'] % 1000 == 500,
+                                   total=total)
+    reds, greens, blues = red.tobytes(), green.tobytes(), blue.tobytes()
+    for index in compress(range(len(pixels)), halves.convert('L').tobytes()):
+        pixels[index] = round(.299 * reds[index] + .587 * greens[index]
+                              + .114 * blues[index])
+    return pixels
+
+
+@_instrumented('greyscale', lambda args, result: {'pixels': len(result)})
+def greyscale_bytes(raw, mode, stride):
+    """
+    Converts raw interleaved 8-bit samples (stride bytes per pixel) of the
+    given PIL mode into one greyscale byte per pixel.
+    """
+    if mode.startswith("RGB"):
+        return _luminance(Image.frombytes(mode, (len(raw) // stride, 1), bytes(raw)))
+    if mode == "LA":
+        return bytearray(raw[0::stride])
+    if mode == "L":
+        return bytearray(raw)
+    raise ValueError(f"Unsupported image mode: {mode}")
+
+
+def _palette_greyscale(img):
+    """
+    Converts a palette (P or PA) image: the palette is converted once, then
+    each pixel's index is translated through it.
+    """
+    palette = img.getpalette('RGB') or []
+    palette = bytes(palette) + bytes(768 - len(palette))
+    table = bytes(_luminance(Image.frombytes('RGB', (256, 1), palette)))
+    return bytearray(img.getchannel(0).tobytes()).translate(table)
+
+
+# PIL modes with one 16- or 32-bit integer sample per pixel
+WIDE_MODES = ('I', 'I;16', 'I;16L', 'I;16B', 'I;16N')
+
+
+def _wide_greyscale(img):
+    """
+    Scales 16-bit greyscale samples to 8 bits, round(value / 257), clipping
+    anything outside [0, 65535] (possible in "I" images).
+    """
+    scaled = ImageMath.lambda_eval(lambda args: (args['value'] * 2 + 257) / 514,
+                                   value=img.convert('I'))
+    return bytearray(scaled.convert('L').tobytes())
+
+
+@_instrumented('load', _load_counter)
+def load_greyscale_image(filename, box=None, band=None):
+    """
+    Loads an image from the given file and returns a GreyscaleImage
+    representing that image.  This also performs conversion to greyscale.
+
+    box = (left, upper, right, lower) loads just that region, and band
+    (a name such as "G" or an index) takes one band of the image as the
+    greyscale value instead of converting. L, LA, RGB, RGBA, P (palette) and
+    16-bit (I;16, I) images are supported. filename may also be a binary
+    file-like object.
+
+    Invoked as, for example:
+       i = load_greyscale_image("test_images/cat.png")
+       face = load_greyscale_image("test_images/cat.png", box=(40, 20, 120, 100))
+    """
+    if hasattr(filename, "read"):
+        handle = nullcontext(filename)
+    else:
+        handle = open(filename, "rb")
+    with handle as img_handle:
+        img = Image.open(img_handle)
+        if box is not None:
+            img = img.crop(box)
+        if band is not None:
+            if img.mode not in ("L", "LA", "RGB", "RGBA"):
+                raise ValueError(f"Cannot select a band of a {img.mode} image")
+            pixels = bytearray(img.getchannel(band).tobytes())
+        elif img.mode in ("P", "PA"):
+            pixels = _palette_greyscale(img)
+        elif img.mode in WIDE_MODES:
+            pixels = _wide_greyscale(img)
+        else:
+            # Raw interleaved bands, one byte per sample
+            pixels = greyscale_bytes(img.tobytes(), img.mode, len(img.getbands()))
+        width, height = img.size
+        return GreyscaleImage(height, width, pixels)
+
+
+def _plane_bytes(pixels):
+    """
+    Returns pixels as 8-bit bytes for PIL, rounding and clipping wide
+    results as round_and_clip_image would.
+    """
+    if isinstance(pixels, (array, memoryview)):
+        typecode = pixels.typecode if isinstance(pixels, array) else pixels.format
+        return pixels if typecode == 'B' else _round_and_clip_values(pixels)
+    if isinstance(pixels, (bytes, bytearray)):
+        return pixels
+    try:
+        return bytes(pixels)
+    except (TypeError, ValueError):
+        return _round_and_clip_values(pixels)
+
+
+@_instrumented('save', _save_counter)
+def save_greyscale_image(image, filename, mode="PNG"):
+    """
+    Saves the given image to disk or to a file-like object.  If filename is
+    given as a string, the file type will be inferred from the given name.  If
+    filename is given as a file-like object, the file type will be determined
+    by the "mode" parameter.
+    """
+    out = Image.frombytes("L", (image["width"], image["height"]),
+                          _plane_bytes(image["pixels"]))
+    if isinstance(filename, str):
+        out.save(filename)
+    else:
+        out.save(filename, mode)
+    out.close()
+
+
+@_instrumented('load', _load_counter)
+def load_color_image(filename, box=None):
+    """
+    Loads an image as a planar ColorImage: RGBA if it has transparency,
+    otherwise RGB. PIL splits the bands into one buffer per channel, so no
+    pixel is handled in Python. filename and box work as for
+    load_greyscale_image.
+
+    Invoked as, for example:
+       i = load_color_image("test_images/cat.png")
+       save_color_image(blurred(i, 5), "cat_blur.png")
+    """
+    if hasattr(filename, "read"):
+        handle = nullcontext(filename)
+    else:
+        handle = open(filename, "rb")
+    with handle as img_handle:
+        img = Image.open(img_handle)
+        if box is not None:
+            img = img.crop(box)
+        img = img.convert("RGBA" if img.has_transparency_data else "RGB")
+        width, height = img.size
+        planes = [GreyscaleImage(height, width, bytearray(band.tobytes()))
+                  for band in img.split()]
+        return ColorImage(height, width, img.mode, planes)
+
+
+@_instrumented('save', _save_counter)
+def save_color_image(image, filename, mode="PNG"):
+    """
+    Saves a ColorImage like save_greyscale_image, merging its planes back
+    into interleaved pixels; float planes are rounded and clipped.
+    """
+    size = (image["width"], image["height"])
+    bands = [Image.frombytes("L", size, _plane_bytes(plane["pixels"]))
+             for plane in image["planes"]]
+    out = Image.merge(image["mode"], bands)
+    if isinstance(filename, str):
+        out.save(filename)
+    else:
+        out.save(filename, mode)
+    out.close()
+
+
+# Raw container: magic, width, height, typecode and byte order, padded to 32
+# bytes so that 8-byte pixels stay aligned, then the pixels in native order
+RAW_MAGIC = b'LABRAW01'
+RAW_TYPECODES = ('B', 'q', 'd')
+_RAW_HEADER = struct.Struct('<8sQQcc6x')
+_RAW_ORDER = b'<' if sys.byteorder == 'little' else b'>'
+
+
+def _raw_header(height, width, typecode):
+    return _RAW_HEADER.pack(RAW_MAGIC, width, height, typecode.encode(), _RAW_ORDER)
+
+
+def save_raw_image(image, filename):
+    """
+    Writes an image, 8-bit or float, to an uncompressed raw file that
+    open_raw_image maps straight back into memory. The file is written
+    under a temporary name and renamed, so readers never see half of it.
+    """
+    typecode, pixels = _typed_pixels(image['pixels'])
+    if typecode not in RAW_TYPECODES:
+        pixels = FloatImage.from_values(0, 0, list(pixels)).pixels
+        typecode = pixels.typecode
+    partial = f"{filename}.{os.getpid()}.partial"
+    with open(partial, 'wb') as handle:
+        handle.write(_raw_header(image['height'], image['width'], typecode))
+        handle.write(memoryview(pixels).cast('B'))
+    os.replace(partial, filename)
+
+
+def create_raw_image(filename, height, width, typecode='B'):
+    """
+    Makes a zeroed raw file and returns it mapped for writing, for use as
+    the out= image of a filter.
+    """
+    if typecode not in RAW_TYPECODES:
+        raise ValueError(f"Unsupported raw typecode: {typecode}")
+    with open(filename, 'wb') as handle:
+        handle.write(_raw_header(height, width, typecode))
+        handle.truncate(_RAW_HEADER.size + height * width * array(typecode).itemsize)
+    return open_raw_image(filename, writable=True)
+
+
+def open_raw_image(filename, writable=False):
+    """
+    Maps a file written by save_raw_image or create_raw_image and returns a
+    GreyscaleImage ('B') or FloatImage ('q', 'd') whose pixels are a
+    memoryview of the mapping: nothing is decoded or copied, and pages are
+    read from the page cache as the pixels are used. The mapping is
+    read-only unless writable is set, in which case writes go to the file.
+    It is released once the image's pixels are no longer referenced.
+
+    Invoked as, for example:
+       lab.save_raw_image(lab.correlate(image, kernel, 'extend'), "stage1.raw")
+       intermediate = lab.open_raw_image("stage1.raw")
+    """
+    with open(filename, 'r+b' if writable else 'rb') as handle:
+        header = handle.read(_RAW_HEADER.size)
+        if len(header) < _RAW_HEADER.size or not header.startswith(RAW_MAGIC):
+            raise ValueError(f"{filename} is not a raw image")
+        _, width, height, typecode, order = _RAW_HEADER.unpack(header)
+        typecode = typecode.decode('latin-1')
+        if typecode not in RAW_TYPECODES:
+            raise ValueError(f"Unsupported raw typecode: {typecode}")
+        if order != _RAW_ORDER:
+            raise ValueError(f"{filename} was written with the other byte order")
+        size = _RAW_HEADER.size + height * width * array(typecode).itemsize
+        if os.fstat(handle.fileno()).st_size < size:
+            raise ValueError(f"{filename} is truncated")
+        if height * width == 0:
+            pixels = bytearray() if typecode == 'B' else array(typecode)
+        else:
+            access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+            mapped = mmap.mmap(handle.fileno(), size, access=access)
+            pixels = memoryview(mapped)[_RAW_HEADER.size:].cast(typecode)
+    if typecode == 'B':
+        return GreyscaleImage(height, width, pixels)
+    return FloatImage(height, width, pixels)
 
 
 if __name__ == "__main__":
-    image_in = load_greyscale_image("test_images/mario.png")
-    image_out = edges(image_in)
-    save_greyscale_image(image_out, "edges.png")
+    # e.g. python lab.py "test_images/*.png" --filter edges --output out/
+    import batch
+    raise SystemExit(batch.main())
 
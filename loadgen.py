@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""
+Load generator for the image filter service
+- Posts an image to a running server.py from many concurrent connections
+  and reports throughput, status codes and latency percentiles
+
+Invoked as, for example:
+   python loadgen.py test_images/cat.png --spec blur:3 --requests 500 --concurrency 32
+   python loadgen.py test_images/cat.png --unix /tmp/filters.sock --spec edges
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import Counter
+
+from server import percentiles
+
+
+async def request(method, target, body=b'', host='127.0.0.1', port=8080, path=None):
+    """
+    Sends one HTTP request on a new connection and returns (status, body).
+    """
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    try:
+        head = (f"{method} {target} HTTP/1.1\r\nHost: {host}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n")
+        writer.write(head.encode() + body)
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        return status, await reader.readexactly(length)
+    finally:
+        writer.close()
+
+
+async def run_load(body, spec, requests=100, concurrency=8, host='127.0.0.1', port=8080,
+                   path=None):
+    """
+    Posts body to /filter?spec=... `requests` times from `concurrency`
+    clients at once and returns a summary dict.
+    """
+    statuses = Counter()
+    latencies = []
+    remaining = iter(range(requests))
+
+    async def client():
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                status, _ = await request('POST', f'/filter?spec={spec}', body,
+                                          host, port, path)
+            except OSError:
+                status = 'error'
+            statuses[status] += 1
+            if status == 200:
+                latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    return {'requests': requests, 'seconds': seconds,
+            'requests_per_second': requests / max(seconds, 1e-9),
+            'statuses': dict(statuses), 'latency_ms': percentiles(latencies)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the image filter service.")
+    parser.add_argument('image', help="image file to post")
+    parser.add_argument('--spec', default='blur:3',
+                        help="filter chain, e.g. invert,edges")
+    parser.add_argument('-n', '--requests', type=int, default=100)
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix', metavar='PATH',
+                        help="connect to a Unix socket instead")
+    args = parser.parse_args(argv)
+
+    with open(args.image, 'rb') as handle:
+        body = handle.read()
+    summary = asyncio.run(run_load(body, args.spec, args.requests, args.concurrency,
+                                   args.host, args.port, args.unix))
+    server_stats = asyncio.run(request('GET', '/stats', host=args.host, port=args.port,
+                                       path=args.unix))[1]
+    summary['server'] = json.loads(server_stats)
+    print(json.dumps(summary, indent=2))
+    return 0 if set(summary['statuses']) <= {200, 503} else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
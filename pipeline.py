@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""
+Lazy filter pipelines
+- Records chains of lab filters and only runs them when a result is
+  requested, fusing the whole chain into one pass over the image rows
+"""
+
+import lab
+
+
+def _invert(color):
+    return 255 - color
+
+
+class Pipeline:
+    """
+    A lazily evaluated chain of filters on one source image.
+
+    Each method returns a new Pipeline extending the chain; nothing runs until
+    compute() is called. For example:
+       edges = Pipeline(image).inverted().blurred(3).edges()
+       result = edges.compute()
+    """
+
+    def __init__(self, image, parent=None, op=None):
+        self.image = image
+        self.parent = parent
+        self.op = op
+        self._result = None
+
+    def _then(self, *op):
+        return Pipeline(self.image, self, op)
+
+    def inverted(self):
+        return self._then('point', _invert)
+
+    def point(self, func):
+        """
+        Applies func to every pixel, rounding and clipping the result to 8 bits.
+        """
+        return self._then('point', func)
+
+    def blurred(self, kernel_size):
+        return self._then('blur', kernel_size)
+
+    def sharpened(self, kernel_size):
+        return self._then('sharpen', kernel_size)
+
+    def edges(self):
+        return self._then('edges', None)
+
+    def median_filtered(self, kernel_size):
+        return self._then('median', kernel_size)
+
+    def _pending(self):
+        """
+        Returns (start image, ops) where start is the nearest computed result
+        on the chain (or the source image) and ops are the ops after it.
+        """
+        ops = []
+        node = self
+        while node.parent is not None and node._result is None:
+            ops.append(node.op)
+            node = node.parent
+        start = node._result if node._result is not None else node.image
+        return start, ops[::-1]
+
+    def plan(self):
+        """
+        Returns the stages compute() would run: consecutive point operations
+        are merged into a single ('point', [funcs]) stage.
+        """
+        stages = []
+        for name, arg in self._pending()[1]:
+            if name == 'point' and stages and stages[-1][0] == 'point':
+                stages[-1][1].append(arg)
+            elif name == 'point':
+                stages.append(('point', [arg]))
+            else:
+                stages.append((name, arg))
+        return stages
+
+    def compute(self):
+        """
+        Runs the pipeline and returns the resulting GreyscaleImage.
+
+        Stages are chained as row generators, so intermediate images are never
+        materialized: each stage holds only the rows its kernel needs. Every
+        stage rounds and clips to 8 bits exactly as the lab filters do.
+        """
+        if self._result is not None:
+            return self._result
+        start, _ = self._pending()
+        height, width = start['height'], start['width']
+        rows = lab._image_rows(start)
+        for name, arg in self.plan():
+            if name == 'point':
+                rows = _point_rows(rows, arg)
+            else:
+                rows = lab.filter_rows(rows, height, width, name, arg)
+        pixels = bytearray()
+        for line in rows:
+            pixels += line
+        self._result = lab.GreyscaleImage(height, width, pixels)
+        return self._result
+
+
+def _point_rows(rows, funcs):
+    """
+    Applies a chain of point operations to each row through one merged
+    lookup table.
+    """
+    table = lab.compose_point_tables(*map(lab.point_table, funcs))
+    for line in rows:
+        yield bytearray(line).translate(table)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+"""
+Image pyramids for fast approximate previews
+- Halves an image repeatedly by area averaging, caching every level, and
+  runs the lab filters at a chosen level with the kernel scaled to match,
+  upsampling the result back to full size
+"""
+
+import math
+from operator import add, sub
+
+import lab
+
+# Filters by name, as in lab.filter_rows
+FILTERS = {'invert': lambda image, kernel_size: lab.inverted(image),
+           'blur': lab.blurred,
+           'sharpen': lab.sharpened,
+           'edges': lambda image, kernel_size: lab.edges(image)}
+
+
+def downsample(image):
+    """
+    Returns the image at half size (rounded up): each pixel is the rounded
+    average of a 2x2 block. An odd last row or column is repeated, as the
+    "extend" edge mode would.
+    """
+    height, width, pixels = image['height'], image['width'], image['pixels']
+    half_height, half_width = (height + 1) // 2, (width + 1) // 2
+    result = bytearray()
+    for row in range(half_height):
+        top = pixels[2 * row * width:(2 * row + 1) * width]
+        bottom_row = min(2 * row + 1, height - 1)
+        bottom = pixels[bottom_row * width:(bottom_row + 1) * width]
+        sums = list(map(add, top, bottom))
+        if width % 2:
+            sums.append(sums[-1])
+        result += lab._fixed_point_values(list(map(add, sums[0::2], sums[1::2])), 4)
+    return lab.GreyscaleImage(half_height, half_width, result)
+
+
+def upsample(image, height, width, factor=None):
+    """
+    Returns the image scaled up to (height x width) by repeating each pixel
+    over a (factor x factor) block (nearest neighbour), cropping the last
+    blocks to fit. Without a factor, the smallest blocks covering the size
+    are used; pyramid levels pass their scale, 2 ** level, since halving
+    rounds up and the sizes alone can give the wrong factor.
+    """
+    if factor is None:
+        factor_rows = -(-height // image['height'])
+        factor_cols = -(-width // image['width'])
+    else:
+        factor_rows = factor_cols = factor
+    small_width, pixels = image['width'], image['pixels']
+    result = bytearray()
+    for row in range(height):
+        source = row // factor_rows
+        line = pixels[source * small_width:(source + 1) * small_width]
+        wide = bytearray(small_width * factor_cols)
+        for offset in range(factor_cols):
+            wide[offset::factor_cols] = line
+        result += wide[:width]
+    return lab.GreyscaleImage(height, width, result)
+
+
+def scaled_kernel_size(kernel_size, level):
+    """
+    Returns the odd kernel size covering the same area at a pyramid level
+    as kernel_size does at full resolution (at least 1). Level 0 is full
+    resolution, so kernel_size is returned unchanged, even or not.
+    """
+    if kernel_size is None or level == 0:
+        return kernel_size
+    return max(1, 2 * round((kernel_size / 2 ** level - 1) / 2) + 1)
+
+
+def image_error(result, reference):
+    """
+    Compares two images of the same size, returning a dict with the mean
+    and largest absolute pixel difference and the PSNR in decibels
+    (infinite for identical images).
+    """
+    differences = list(map(abs, map(sub, result['pixels'], reference['pixels'])))
+    squared = (sum(difference * difference for difference in differences)
+               / len(differences))
+    return {'mean_absolute': sum(differences) / len(differences),
+            'max_absolute': max(differences),
+            'psnr': math.inf if squared == 0 else 10 * math.log10(255 ** 2 / squared)}
+
+
+class Pyramid:
+    """
+    A lazily built stack of ever smaller copies of an image: level 0 is the
+    image itself and each level halves the one before, down to 1x1. Levels
+    and filtered results are cached, so repeated previews are cheap.
+
+    Invoked as, for example:
+       pyramid = Pyramid(image)
+       quick = pyramid.preview('blur', 15, level=2)
+       print(pyramid.error('blur', 15, level=2))
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self._levels = [image]
+        self._filtered = {}
+
+    @property
+    def depth(self):
+        """
+        The number of levels, down to a single pixel.
+        """
+        return max(self.image['height'], self.image['width'], 1).bit_length()
+
+    def level(self, level):
+        """
+        Returns the image at a level, building the levels above it as needed.
+        """
+        if not 0 <= level < self.depth:
+            raise ValueError(f"Level must be between 0 and {self.depth - 1}")
+        while len(self._levels) <= level:
+            self._levels.append(downsample(self._levels[-1]))
+        return self._levels[level]
+
+    def filtered(self, name, kernel_size=None, level=0):
+        """
+        Returns the filter `name` run on the image at a level, with the
+        kernel size scaled to that level.
+        """
+        key = (name, kernel_size, level)
+        if key not in self._filtered:
+            if name not in FILTERS:
+                raise ValueError(f"Unknown filter: {name}")
+            self._filtered[key] = FILTERS[name](self.level(level),
+                                                scaled_kernel_size(kernel_size, level))
+        return self._filtered[key]
+
+    def preview(self, name, kernel_size=None, level=1):
+        """
+        Returns an approximation of the filter at full resolution: the
+        filter runs at a level and the result is upsampled. Each level
+        cuts the work about four times.
+        """
+        result = self.filtered(name, kernel_size, level)
+        if level == 0:
+            return result
+        return upsample(result, self.image['height'], self.image['width'], 2 ** level)
+
+    def error(self, name, kernel_size=None, level=1):
+        """
+        Returns image_error of a preview against the full-resolution result,
+        FILTERS[name](image, kernel_size) (cached as level 0).
+        """
+        return image_error(self.preview(name, kernel_size, level),
+                           self.filtered(name, kernel_size, 0))
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+
+"""
+Image filter service
+- A local asyncio HTTP server (TCP or Unix socket) that filters posted
+  images in a pool of worker processes, grouping small concurrent requests
+  for the same filter chain into micro-batches and refusing work with 503
+  once its queue is full
+
+Endpoints:
+   POST /filter?spec=blur:7,edges   body: an image file; replies with a PNG
+   GET /stats                       counters, queue depth and latency percentiles
+
+Invoked as, for example:
+   python server.py --port 8080 --workers 4
+   python server.py --unix /tmp/filters.sock
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import batch
+import lab
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error',
+           503: 'Service Unavailable'}
+
+
+class Overloaded(Exception):
+    """
+    Raised when the server's queue is full.
+    """
+
+
+def filter_images(stages, bodies):
+    """
+    Worker job: filters each encoded image in a batch. Returns a
+    (status, body) pair per image, so one bad image does not fail the rest:
+    400 if it cannot be read, 500 if filtering it fails.
+    """
+    results = []
+    for body in bodies:
+        try:
+            image = lab.load_greyscale_image(io.BytesIO(body))
+        except Exception as error:
+            results.append((400, f"Cannot read image: {error}".encode()))
+            continue
+        try:
+            out = io.BytesIO()
+            lab.save_greyscale_image(batch.apply_stages(image, stages), out)
+        except Exception as error:
+            results.append((500, f"Filter failed: {error}".encode()))
+            continue
+        results.append((200, out.getvalue()))
+    return results
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """
+    Returns {"p50": ..., ...} for a sequence of values, by nearest rank.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return {f'p{point}': None for point in points}
+    return {f'p{point}': ordered[min(len(ordered) - 1, len(ordered) * point // 100)]
+            for point in points}
+
+
+class FilterServer:
+    """
+    Filters images posted over HTTP in a pool of worker processes.
+
+    Requests with bodies of at most small_bytes are grouped by filter chain:
+    the first waits up to batch_delay seconds for up to max_batch - 1 more to
+    arrive, then the whole batch goes to a worker as one job. At most
+    max_pending requests are queued or running; beyond that requests are
+    answered with 503 straight away.
+
+    Invoked as, for example:
+       server = FilterServer(workers=4)
+       await server.start(port=8080)
+       await server.serve_forever()
+    """
+
+    def __init__(self, workers=None, max_pending=64, max_batch=8, batch_delay=0.002,
+                 small_bytes=1 << 18, max_body=64 << 20, latency_window=10000):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.max_batch = max_batch
+        self.batch_delay = batch_delay
+        self.small_bytes = small_bytes
+        self.max_body = max_body
+        self.counters = {'requests': 0, 'completed': 0, 'rejected': 0, 'failed': 0,
+                         'batches': 0, 'batched_requests': 0}
+        self.latencies = deque(maxlen=latency_window)
+        self._pending = 0
+        self._batches = {}
+        self._tasks = set()
+        self._pool = None
+        self._server = None
+
+    async def start(self, host='127.0.0.1', port=8080, path=None):
+        """
+        Starts listening on host:port, or on the Unix socket at path.
+        """
+        self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._handle, path=path)
+        else:
+            self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server
+
+    @property
+    def address(self):
+        return self._server.sockets[0].getsockname()
+
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        self._pool.shutdown()
+
+    def stats(self):
+        """
+        Returns the counters, the queue depth and latency percentiles in
+        milliseconds over the most recent requests.
+        """
+        latencies = percentiles([seconds * 1000 for seconds in self.latencies])
+        return {**self.counters, 'pending': self._pending, 'latency_ms': latencies}
+
+    async def submit(self, stages, body):
+        """
+        Filters one encoded image, returning (status, body). Raises
+        Overloaded if the queue is full.
+        """
+        if self._pending >= self.max_pending:
+            self.counters['rejected'] += 1
+            raise Overloaded()
+        self._pending += 1
+        try:
+            if len(body) > self.small_bytes:
+                return (await self._run(stages, [body]))[0]
+            future = asyncio.get_running_loop().create_future()
+            self._enqueue(tuple(stages), body, future)
+            return await future
+        finally:
+            self._pending -= 1
+
+    def _enqueue(self, key, body, future):
+        waiting = self._batches.get(key)
+        if waiting is None:
+            waiting = self._batches[key] = []
+            asyncio.get_running_loop().call_later(self.batch_delay, self._flush, key,
+                                                  waiting)
+        waiting.append((body, future))
+        if len(waiting) >= self.max_batch:
+            self._flush(key, waiting)
+
+    def _flush(self, key, waiting):
+        # The timer may fire after the batch already left full
+        if self._batches.get(key) is not waiting:
+            return
+        del self._batches[key]
+        task = asyncio.ensure_future(self._run_batch(list(key), waiting))
+        # Hold a reference until the batch is done
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, stages, bodies):
+        self.counters['batches'] += 1
+        self.counters['batched_requests'] += len(bodies)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, filter_images, stages, bodies)
+
+    async def _run_batch(self, stages, waiting):
+        try:
+            results = await self._run(stages, [body for body, _ in waiting])
+        except Exception as error:
+            for _, future in waiting:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for (_, future), result in zip(waiting, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _respond(self, method, target, body):
+        """
+        Returns (status, content type, body) for one request.
+        """
+        url = urlsplit(target)
+        if url.path == '/stats':
+            if method != 'GET':
+                return 405, 'text/plain', b"Use GET"
+            return 200, 'application/json', json.dumps(self.stats()).encode()
+        if url.path != '/filter':
+            return 404, 'text/plain', b"Not found"
+        if method != 'POST':
+            return 405, 'text/plain', b"Use POST"
+        try:
+            stages = batch.parse_filter_spec(parse_qs(url.query).get('spec', [''])[0])
+        except ValueError as error:
+            return 400, 'text/plain', str(error).encode()
+        try:
+            status, result = await self.submit(stages, body)
+        except Overloaded:
+            return 503, 'text/plain', b"Server busy, retry later"
+        except Exception as error:
+            # The whole batch failed, e.g. a worker process died
+            return 500, 'text/plain', f"Filter failed: {error}".encode()
+        return status, 'image/png' if status == 200 else 'text/plain', result
+
+    async def _handle(self, reader, writer):
+        """
+        Serves HTTP/1.1 requests on one connection until the client closes it
+        or asks to.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                start = time.perf_counter()
+                self.counters['requests'] += 1
+                length = int(headers.get('content-length', 0))
+                if length > self.max_body:
+                    status, content_type, body = 413, 'text/plain', b"Image too large"
+                    headers['connection'] = 'close'
+                else:
+                    body = await reader.readexactly(length)
+                    status, content_type, body = await self._respond(method, target,
+                                                                     body)
+                # Only filter requests count as completed or failed
+                filtering = urlsplit(target).path == '/filter'
+                if filtering and status == 200:
+                    self.counters['completed'] += 1
+                    self.latencies.append(time.perf_counter() - start)
+                elif filtering and status != 503:
+                    self.counters['failed'] += 1
+
+                close = headers.get('connection', '').lower() == 'close'
+                head = [f"HTTP/1.1 {status} {REASONS[status]}",
+                        f"Content-Type: {content_type}", f"Content-Length: {len(body)}"]
+                if status == 503:
+                    head.append("Retry-After: 1")
+                if close:
+                    head.append("Connection: close")
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve lab filters over HTTP.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix', metavar='PATH',
+                        help="listen on a Unix socket instead")
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument('--max-pending', type=int, default=64,
+                        help="queued or running requests before answering 503")
+    parser.add_argument('--max-batch', type=int, default=8,
+                        help="requests per micro-batch")
+    parser.add_argument('--batch-delay', type=float, default=0.002,
+                        help="seconds a micro-batch waits to fill")
+    args = parser.parse_args(argv)
+
+    async def serve():
+        server = FilterServer(args.workers, args.max_pending, args.max_batch,
+                              args.batch_delay)
+        await server.start(args.host, args.port, args.unix)
+        print(f"Listening on {args.unix or f'{args.host}:{args.port}'}")
+        try:
+            await server.serve_forever()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+"""
+Streaming PNG filtering for images larger than memory
+- Decodes PNG scanlines incrementally, runs a lab filter on a sliding
+  window of rows and encodes each output row as soon as it is finished
+"""
+
+import struct
+import zlib
+from itertools import accumulate
+from operator import add
+
+import lab
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG colour type -> (PIL mode, samples per pixel)
+COLOR_TYPES = {0: ('L', 1), 2: ('RGB', 3), 4: ('LA', 2), 6: ('RGBA', 4)}
+
+# Scanlines decompressed at a time
+DECOMPRESS_LINES = 4
+
+# IDAT chunks are written once this much compressed data has built up
+IDAT_SIZE = 1 << 16
+
+
+def _read_chunk(handle):
+    """
+    Reads one PNG chunk, returning (type, data).
+    """
+    header = handle.read(8)
+    if len(header) < 8:
+        raise ValueError("Truncated PNG file")
+    length, chunk_type = struct.unpack('>I4s', header)
+    data = handle.read(length)
+    handle.read(4)  # CRC
+    return chunk_type, data
+
+
+def _write_chunk(handle, chunk_type, data):
+    handle.write(struct.pack('>I', len(data)) + chunk_type + data)
+    handle.write(struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+
+def _paeth(left, up, up_left):
+    estimate = left + up - up_left
+    distance_left = abs(estimate - left)
+    distance_up = abs(estimate - up)
+    distance_up_left = abs(estimate - up_left)
+    if distance_left <= distance_up and distance_left <= distance_up_left:
+        return left
+    if distance_up <= distance_up_left:
+        return up
+    return up_left
+
+
+def _unfilter(filter_type, line, prior, stride):
+    """
+    Reverses the PNG filter of one scanline given the previous decoded one.
+    """
+    if filter_type == 0:
+        return bytearray(line)
+    if filter_type == 1:
+        recon = bytearray(len(line))
+        for band in range(stride):
+            sums = accumulate(line[band::stride])
+            recon[band::stride] = bytes(map((255).__and__, sums))
+        return recon
+    if filter_type == 2:
+        return bytearray(map((255).__and__, map(add, line, prior)))
+    recon = bytearray(line)
+    for i in range(len(recon)):
+        left = recon[i - stride] if i >= stride else 0
+        if filter_type == 3:
+            recon[i] = (recon[i] + ((left + prior[i]) >> 1)) & 255
+        elif filter_type == 4:
+            up_left = prior[i - stride] if i >= stride else 0
+            recon[i] = (recon[i] + _paeth(left, prior[i], up_left)) & 255
+        else:
+            raise ValueError(f"Unknown PNG filter type: {filter_type}")
+    return recon
+
+
+class PngRowReader:
+    """
+    Iterates over the greyscale rows of an 8-bit, non-interlaced PNG file
+    without decoding the whole image. Rows are converted to greyscale exactly
+    like lab.load_greyscale_image.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as handle:
+            if handle.read(8) != PNG_SIGNATURE:
+                raise ValueError(f"{filename} is not a PNG file")
+            chunk_type, data = _read_chunk(handle)
+        if chunk_type != b'IHDR':
+            raise ValueError("PNG file does not start with IHDR")
+        (self.width, self.height, bit_depth, color_type,
+         _, _, interlace) = struct.unpack('>IIBBBBB', data)
+        if bit_depth != 8 or color_type not in COLOR_TYPES or interlace:
+            raise ValueError("Streaming supports 8-bit, non-interlaced "
+                             "L/LA/RGB/RGBA PNG files")
+        self.mode, self.stride = COLOR_TYPES[color_type]
+
+    def _decompressed(self, handle, piece_size):
+        """
+        Yields the decompressed image data in pieces of at most piece_size bytes.
+        """
+        decompressor = zlib.decompressobj()
+        while True:
+            chunk_type, data = _read_chunk(handle)
+            if chunk_type == b'IEND':
+                break
+            if chunk_type != b'IDAT':
+                continue
+            while data:
+                yield decompressor.decompress(data, piece_size)
+                data = decompressor.unconsumed_tail
+        yield decompressor.flush()
+
+    def __iter__(self):
+        line_size = self.width * self.stride
+        pending = bytearray()
+        prior = bytes(line_size)
+        decoded = 0
+        with open(self.filename, 'rb') as handle:
+            handle.read(8)
+            for piece in self._decompressed(handle, DECOMPRESS_LINES * (line_size + 1)):
+                pending += piece
+                while len(pending) > line_size and decoded < self.height:
+                    prior = _unfilter(pending[0], pending[1:line_size + 1], prior,
+                                      self.stride)
+                    del pending[:line_size + 1]
+                    decoded += 1
+                    yield lab.greyscale_bytes(prior, self.mode, self.stride)
+                if decoded == self.height:
+                    return
+        raise ValueError("Truncated PNG image data")
+
+
+def write_png_rows(filename, width, height, rows, level=6):
+    """
+    Writes an 8-bit greyscale PNG from an iterator over its rows, compressing
+    each row as it arrives.
+    """
+    compressor = zlib.compressobj(level)
+    with open(filename, 'wb') as handle:
+        handle.write(PNG_SIGNATURE)
+        header = struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+        _write_chunk(handle, b'IHDR', header)
+        compressed = bytearray()
+        written = 0
+        for line in rows:
+            compressed += compressor.compress(b'\x00' + bytes(line))
+            written += 1
+            if len(compressed) >= IDAT_SIZE:
+                _write_chunk(handle, b'IDAT', bytes(compressed))
+                compressed.clear()
+        if written != height:
+            raise ValueError(f"Expected {height} rows, got {written}")
+        compressed += compressor.flush()
+        _write_chunk(handle, b'IDAT', bytes(compressed))
+        _write_chunk(handle, b'IEND', b'')
+
+
+def open_rows(filename):
+    """
+    Returns (height, width, rows) for an image file, where rows iterates over
+    its greyscale rows. PNG files we can stream are decoded incrementally;
+    anything else PIL reads is loaded whole.
+    """
+    try:
+        reader = PngRowReader(filename)
+    except ValueError:
+        image = lab.load_greyscale_image(filename)
+        return image['height'], image['width'], lab._image_rows(image)
+    return reader.height, reader.width, iter(reader)
+
+
+def stream_filter(in_filename, out_filename, name, kernel_size=None):
+    """
+    Applies the lab filter `name` ("invert", "blur", "sharpen", "edges" or
+    "median") to an image file and writes a greyscale PNG, holding only a
+    window of kernel_size rows in memory.
+
+    Invoked as, for example:
+       stream_filter("scan.png", "scan_blur.png", "blur", 7)
+    """
+    height, width, rows = open_rows(in_filename)
+    write_png_rows(out_filename, width, height,
+                   lab.filter_rows(rows, height, width, name, kernel_size))
@@ -2,9 +2,25 @@
 
 import os
 import pickle
+import asyncio
 import hashlib
+import io
+import json
+import math
+import tracemalloc
+from array import array
+from fractions import Fraction
 
+import batch
+import bench
+import cache
+import frames
 import lab
+import loadgen
+import pipeline
+import pyramid
+import server
+import streaming
 import pytest
 
 TEST_DIRECTORY = os.path.dirname(__file__)
@@ -49,10 +65,12 @@ def test_load():
     compare_images(result, expected)
 
 def test_round_and_clip():
-    result = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel.png'))
-    if not result:
+    loaded = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel.png'))
+    if not loaded:
         print("No image")
 
+    # 8-bit images cannot hold out-of-range values, so widen to a float buffer first
+    result = lab.FloatImage.from_values(loaded['height'], loaded['width'], loaded['pixels'])
     result['pixels'][0] = 1000
     result['pixels'][1] = -1999
 
@@ -385,3 +403,964 @@ def test_edges_centered_pixel():
     }
     print(result)
     compare_images(result, expected)
+
+
+def correlate_reference(image, kernel, boundary_behavior):
+    # Direct per-pixel definition of correlation, summed in row-major tap order
+    growth = kernel['height'] // 2
+    pixels = []
+    for row in range(image['height']):
+        for col in range(image['width']):
+            total = 0
+            for y in range(-growth, growth + 1):
+                for x in range(-growth, growth + 1):
+                    k = lab.get_pixel_mode(kernel, growth + y, growth + x, boundary_behavior)
+                    total += lab.get_pixel_mode(image, row + y, col + x, boundary_behavior) * k
+            pixels.append(total)
+    return {'height': image['height'], 'width': image['width'], 'pixels': pixels}
+
+
+@pytest.mark.parametrize("boundary", ['zero', 'wrap', 'extend'])
+@pytest.mark.parametrize("kernel", [
+    {'height': 3, 'width': 3, 'pixels': [1, -2, 0, 3, 1, 0, 0, 2, -1]},
+    {'height': 5, 'width': 5, 'pixels': [(i % 7) / 9 - 0.3 for i in range(25)]},
+])
+def test_correlate_matches_reference(kernel, boundary):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'pattern.png'))
+    result = lab.correlate(im, kernel, boundary)
+    expected = correlate_reference(im, kernel, boundary)
+    assert (result['height'], result['width']) == (expected['height'], expected['width'])
+    assert list(result['pixels']) == expected['pixels']
+
+
+
+@pytest.mark.parametrize("boundary", ['zero', 'wrap', 'extend'])
+def test_correlate_methods_agree(boundary):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel.png'))
+    weights = [1, 3, 0, -2, 5, 1, -1]
+    separable = {'height': 7, 'width': 6, 'pixels': [a * b for a in weights for b in weights[:6]]}
+    dense = {'height': 9, 'width': 9, 'pixels': [(i * i) % 11 - 4 for i in range(81)]}
+    for kernel in (separable, dense):
+        expected = lab.correlate(im, kernel, boundary, method='direct')
+        assert lab.correlate(im, kernel, boundary, method='fft') == expected
+        if kernel is separable:
+            assert lab.correlate(im, kernel, boundary, method='separable') == expected
+    with pytest.raises(ValueError):
+        lab.correlate(im, dense, boundary, method='separable')
+
+    floats = {'height': 9, 'width': 9, 'pixels': [(i % 7) / 9 - 0.3 for i in range(81)]}
+    expected = lab.correlate(im, floats, boundary, method='direct')
+    result = lab.correlate(im, floats, boundary, method='fft')
+    limit = lab.FLOAT_TOLERANCE * sum(map(abs, floats['pixels'])) * 255
+    assert all(abs(a - b) <= limit for a, b in zip(result['pixels'], expected['pixels']))
+
+
+def test_correlation_method():
+    assert lab.correlation_method(256, 256, lab.generate_kernel(3, 1)) == 'separable'
+    assert lab.correlation_method(256, 256, {'height': 3, 'width': 3, 'pixels': [1, -2, 0, 3, 1, 0, 0, 2, -1]}) == 'direct'
+    big = {'height': 41, 'width': 41, 'pixels': [(i % 7) / 9 for i in range(41 * 41)]}
+    assert lab.correlation_method(256, 256, big) == 'fft'
+
+
+@pytest.mark.parametrize("boundary", ['zero', 'wrap', 'extend'])
+def test_fft_tiles(boundary):
+    # Larger than one FFT block, so the image is correlated in tiles
+    size = lab.FFT_BLOCK + 20
+    im = lab.GreyscaleImage(size, size - 7, bytearray((i * 37 + i // 13) % 256 for i in range(size * (size - 7))))
+    assert lab._fft_tiling(size, 4) == (lab.FFT_BLOCK - 8, lab.FFT_BLOCK)
+    dense = {'height': 9, 'width': 9, 'pixels': [(i * i) % 11 - 4 for i in range(81)]}
+    assert lab.correlate(im, dense, boundary, method='fft') == lab.correlate(im, dense, boundary, method='direct')
+
+    # Transform sizes are bounded by the block, not by the image
+    assert lab._fft_tiling(8192, 15) == (lab.FFT_BLOCK - 30, lab.FFT_BLOCK)
+
+@pytest.mark.parametrize("kernsize", [2, 4, 5, 15, 16, 41])
+def test_box_filters_match_correlate(kernsize):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'pattern.png'))
+    box = lab.generate_kernel(kernsize, 1/(kernsize**2))
+    expected = lab.round_and_clip_image(lab.correlate(im, box, 'extend'))
+    compare_images(lab.blurred(im, kernsize), expected)
+
+    unsharp = lab.generate_kernel(kernsize, -1/(kernsize**2))
+    # The center tap, which even kernels have at (size // 2, size // 2)
+    unsharp['pixels'][(kernsize // 2) * (kernsize + 1)] += 2
+    expected = lab.round_and_clip_image(lab.correlate(im, unsharp, 'extend'))
+    compare_images(lab.sharpened(im, kernsize), expected)
+
+
+
+def test_fixed_point_rounding():
+    totals = list(range(-40, 40))
+    for divisor in (1, 2, 4, 9, 36):
+        expected = [round(Fraction(total, divisor)) for total in totals]
+        assert lab._rounded_quotients(totals, divisor) == expected
+    assert list(lab._fixed_point_values([-7, 0, 511, 600], 2)) == [0, 0, 255, 255]
+
+    # Even kernel sizes round exact halves to even
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'pattern.png'))
+    sums = lab.correlate(im, lab.generate_kernel(6, 1), 'extend')['pixels']
+    expected = [max(0, min(255, round(Fraction(total, 36)))) for total in sums]
+    assert list(lab.blurred(im, 6)['pixels']) == expected
+
+    first = lab.correlate(im, lab.SOBEL_KERNEL_FIRST, 'extend')['pixels']
+    second = lab.correlate(im, lab.SOBEL_KERNEL_SECOND, 'extend')['pixels']
+    expected = [min(255, round(math.sqrt(x * x + y * y))) for x, y in zip(first, second)]
+    assert list(lab._sobel_magnitudes(first, second)) == expected
+    assert list(lab._sobel_magnitudes([255, 180, 181], [0, 180, 181])) == [255, 255, 255]
+
+def test_greyscale_image_representation():
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'cat.png'))
+    assert isinstance(im, lab.GreyscaleImage)
+    assert isinstance(im['pixels'], bytearray)
+    assert set(im.keys()) == {'height', 'width', 'pixels'}
+    assert dict(im)['height'] == im.height == 184
+    with pytest.raises(KeyError):
+        im['depth']
+
+    result = lab.correlate(im, {'height': 1, 'width': 1, 'pixels': [0.5]}, 'zero')
+    assert isinstance(result, lab.FloatImage)
+    assert result['pixels'][0] == im['pixels'][0] * 0.5
+    assert isinstance(lab.round_and_clip_image(result), lab.GreyscaleImage)
+
+
+def test_save_load_roundtrip(tmp_path):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'mushroom.png'))
+    filename = str(tmp_path / 'mushroom.png')
+    lab.save_greyscale_image(im, filename)
+    compare_images(lab.load_greyscale_image(filename), im)
+
+    # Wide and list pixels are rounded and clipped on the way out
+    wide = lab.FloatImage.from_values(1, 4, [-3, 7.4, 254.6, 300])
+    lab.save_greyscale_image(wide, filename)
+    assert list(lab.load_greyscale_image(filename)['pixels']) == [0, 7, 255, 255]
+    lab.save_greyscale_image({'height': 1, 'width': 2, 'pixels': [5, 9]}, filename)
+    assert list(lab.load_greyscale_image(filename)['pixels']) == [5, 9]
+
+
+def test_load_modes(tmp_path):
+    from PIL import Image
+    rgb = Image.open(os.path.join(TEST_DIRECTORY, 'test_images', 'mario.png')).convert('RGB')
+    rgb.save(str(tmp_path / 'rgb.png'))
+    raw = rgb.tobytes()
+    expected = [round(.299 * r + .587 * g + .114 * b)
+                for r, g, b in zip(raw[0::3], raw[1::3], raw[2::3])]
+    im = lab.load_greyscale_image(str(tmp_path / 'rgb.png'))
+    assert list(im['pixels']) == expected
+
+    rgb.quantize(64).save(str(tmp_path / 'palette.png'))
+    palette = Image.open(str(tmp_path / 'palette.png'))
+    assert palette.mode == 'P'
+    colours = palette.convert('RGB').tobytes()
+    expected = [round(.299 * r + .587 * g + .114 * b)
+                for r, g, b in zip(colours[0::3], colours[1::3], colours[2::3])]
+    assert list(lab.load_greyscale_image(str(tmp_path / 'palette.png'))['pixels']) == expected
+
+    wide = Image.new('I;16', (4, 1))
+    wide.putdata([0, 128, 129, 65535])
+    wide.save(str(tmp_path / 'wide.png'))
+    assert list(lab.load_greyscale_image(str(tmp_path / 'wide.png'))['pixels']) == [0, 0, 1, 255]
+
+    region = lab.load_greyscale_image(str(tmp_path / 'rgb.png'), box=(10, 20, 40, 30))
+    assert (region['height'], region['width']) == (10, 30)
+    assert lab.get_pixel(region, 3, 5) == lab.get_pixel(im, 23, 15)
+    green = lab.load_greyscale_image(str(tmp_path / 'rgb.png'), band='G')
+    assert green['pixels'] == raw[1::3]
+
+
+@pytest.mark.parametrize("boundary", ['zero', 'wrap', 'extend'])
+def test_correlate_parallel_matches_serial(boundary):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'blob.png'))
+    kernel = {'height': 5, 'width': 5, 'pixels': [(i % 7) / 9 - 0.3 for i in range(25)]}
+    box = lab.generate_kernel(5, 1 / 25)
+    for kernel in (kernel, box):
+        expected = lab.correlate(im, kernel, boundary, method='direct')
+        result = lab.correlate(im, kernel, boundary, workers=2)
+        assert result['pixels'] == expected['pixels']
+    for method in ('separable', 'fft'):
+        with pytest.raises(ValueError):
+            lab.correlate(im, box, boundary, workers=2, method=method)
+
+
+@pytest.mark.parametrize("name, kernsize", [('invert', None), ('blur', 3), ('blur', 4),
+                                             ('sharpen', 5), ('edges', None)])
+def test_stream_filter_matches_filters(tmp_path, name, kernsize):
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', 'twocats.png')
+    outfile = str(tmp_path / 'out.png')
+    streaming.stream_filter(inpfile, outfile, name, kernsize)
+    im = lab.load_greyscale_image(inpfile)
+    expected = {'invert': lambda: lab.inverted(im),
+                'blur': lambda: lab.blurred(im, kernsize),
+                'sharpen': lambda: lab.sharpened(im, kernsize),
+                'edges': lambda: lab.edges(im)}[name]()
+    compare_images(lab.load_greyscale_image(outfile), expected)
+
+
+def test_stream_filter_memory_independent_of_height(tmp_path):
+    peaks = []
+    for height in (300, 2400):
+        im = {'height': height, 'width': 100,
+              'pixels': [(row * 7 + col * 3) % 256 for row in range(height) for col in range(100)]}
+        inpfile = str(tmp_path / ('tall_%d.png' % height))
+        lab.save_greyscale_image(im, inpfile)
+        tracemalloc.start()
+        streaming.stream_filter(inpfile, str(tmp_path / 'out.png'), 'blur', 3)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    # 2100 more rows of 100 pixels would add at least 210kB if they were held
+    assert peaks[1] - peaks[0] < 32 * 1024
+
+
+def test_pipeline_matches_filters():
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'chess.png'))
+    blurred = pipeline.Pipeline(im).inverted().inverted().inverted().blurred(3)
+    chain = blurred.sharpened(5).edges()
+    assert chain.plan() == [('point', [pipeline._invert] * 3), ('blur', 3), ('sharpen', 5),
+                            ('edges', None)]
+    expected = lab.edges(lab.sharpened(lab.blurred(lab.inverted(im), 3), 5))
+    compare_images(chain.compute(), expected)
+
+    # Once an intermediate is observed, later results continue from it
+    compare_images(blurred.compute(), lab.blurred(lab.inverted(im), 3))
+    assert blurred.edges().plan() == [('edges', None)]
+
+
+def test_point_tables():
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'mushroom.png'))
+    gamma = lab.gamma_table(0.5)
+    stretch = lab.contrast_stretch_table(20, 200)
+    threshold = lab.threshold_table(128)
+    assert stretch[10] == 0 and stretch[200] == 255 and threshold[127] == 0 and threshold[128] == 255
+
+    result = lab.apply_point_ops(im, lambda c: 255 * (c / 255) ** 0.5, lambda c: (c - 20) * 255 / 180)
+    expected = [stretch[gamma[c]] for c in im['pixels']]
+    assert list(result['pixels']) == expected
+    assert lab.apply_point_table(im, lab.compose_point_tables(gamma, stretch, threshold)) == \
+        lab.apply_point_table(lab.apply_point_table(lab.apply_point_table(im, gamma), stretch), threshold)
+
+
+def test_apply_per_pixel_wide_results():
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel.png'))
+    result = lab.apply_per_pixel(im, lambda c: c * 2 - 0.5)
+    assert isinstance(result, lab.FloatImage)
+    assert list(result['pixels']) == [c * 2 - 0.5 for c in im['pixels']]
+    # func only sees values that occur
+    assert list(lab.apply_per_pixel(im, lambda c: 1020 // (c + 4) if c in (0, 255) else None)
+                ['pixels']) == [255 if c == 0 else 3 for c in im['pixels']]
+
+
+def test_point_ops_on_wide_pixels(tmp_path):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel.png'))
+    wide = lab.correlate(im, lab.generate_kernel(3, 1 / 9), 'extend')
+    expected = [255 - value for value in wide['pixels']]
+    assert list(lab.inverted(wide)['pixels']) == expected
+    assert list(lab.apply_per_pixel(wide, lambda c: 255 - c)['pixels']) == expected
+    lab.save_raw_image(wide, tmp_path / 'wide.raw')
+    mapped = lab.open_raw_image(tmp_path / 'wide.raw')
+    assert list(lab.inverted(mapped)['pixels']) == expected
+    out = lab.FloatImage(im['height'], im['width'])
+    assert lab.inverted(wide, out=out) is out and list(out['pixels']) == expected
+    with pytest.raises(ValueError):
+        lab.apply_point_table(wide, lab.INVERT_TABLE)
+
+
+@pytest.mark.parametrize("boundary", ['zero', 'wrap', 'extend'])
+def test_pad_image(boundary):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'pattern.png'))
+    padded = lab.pad_image(im, 4, boundary)
+    assert (padded['height'], padded['width']) == (im['height'] + 8, im['width'] + 8)
+    for row in range(padded['height']):
+        for col in range(padded['width']):
+            expected = lab.get_pixel_mode(im, row - 4, col - 4, boundary)
+            assert lab.get_pixel(padded, row, col) == expected
+
+
+@pytest.mark.parametrize("boundary", ['zero', 'wrap', 'extend'])
+def test_correlate_reads_kernel_directly(boundary):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'pattern.png'))
+    # Even and non-square kernels are read as-is, whatever the edge mode
+    result = lab.correlate(im, {'height': 2, 'width': 2, 'pixels': [1, 2, 3, 4]}, boundary)
+    for row in range(im['height']):
+        for col in range(im['width']):
+            def pixel(r, c):
+                return lab.get_pixel_mode(im, r, c, boundary)
+            expected = (pixel(row - 1, col - 1) + 2 * pixel(row - 1, col)
+                        + 3 * pixel(row, col - 1) + 4 * pixel(row, col))
+            assert lab.get_pixel(result, row, col) == expected
+
+    wide = lab.correlate(im, {'height': 1, 'width': 3, 'pixels': [1, 0, -1]}, boundary)
+    square = lab.correlate(im, {'height': 3, 'width': 3, 'pixels': [0, 0, 0, 1, 0, -1, 0, 0, 0]},
+                           boundary)
+    assert wide['pixels'] == square['pixels']
+
+
+def test_parse_filter_spec():
+    assert batch.parse_filter_spec('invert,blur:7,edges') == [('invert', None), ('blur', 7),
+                                                              ('edges', None)]
+    for spec in ('blur', 'sharpen:0', 'edges:3', 'emboss'):
+        with pytest.raises(ValueError):
+            batch.parse_filter_spec(spec)
+
+
+def test_run_batch(tmp_path):
+    inputs = [os.path.join(TEST_DIRECTORY, 'test_images', '%s.png' % name)
+              for name in ('centered_pixel', 'pattern')]
+    stages = batch.parse_filter_spec('invert,blur:3')
+    summary = batch.run_batch(inputs, str(tmp_path), stages, workers=2, report=lambda line: None)
+    assert (summary['processed'], summary['skipped'], summary['failed']) == (2, 0, 0)
+    for inpfile in inputs:
+        result = lab.load_greyscale_image(str(tmp_path / os.path.basename(inpfile)))
+        compare_images(result, lab.blurred(lab.inverted(lab.load_greyscale_image(inpfile)), 3))
+
+    summary = batch.run_batch(inputs, str(tmp_path), stages, workers=2, report=lambda line: None)
+    assert (summary['processed'], summary['skipped']) == (0, 2)
+
+
+def test_run_batch_nested_names(tmp_path):
+    source = os.path.join(TEST_DIRECTORY, 'test_images', 'pattern.png')
+    for directory in ('a', 'b'):
+        os.makedirs(tmp_path / 'in' / directory)
+        with open(source, 'rb') as inp, open(tmp_path / 'in' / directory / 'x.png', 'wb') as out:
+            out.write(inp.read())
+    inputs = batch.find_inputs([str(tmp_path / 'in' / '**' / '*.png')])
+    output_dir = str(tmp_path / 'out')
+    assert batch.output_names(inputs, output_dir) == [os.path.join(output_dir, 'a', 'x.png'),
+                                                      os.path.join(output_dir, 'b', 'x.png')]
+    summary = batch.run_batch(inputs, output_dir, [('invert', None)], workers=1,
+                              report=lambda line: None)
+    assert summary['processed'] == 2
+    compare_images(lab.load_greyscale_image(os.path.join(output_dir, 'b', 'x.png')),
+                   lab.inverted(lab.load_greyscale_image(source)))
+
+    # Names that still collide are refused before any work starts
+    with pytest.raises(ValueError):
+        batch.run_batch(inputs + [str(tmp_path / 'in' / 'a' / 'x.jpg')], output_dir,
+                        [('invert', None)], report=lambda line: None)
+
+
+def test_result_cache(tmp_path):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'pattern.png'))
+    results = cache.ResultCache(directory=str(tmp_path))
+    first = results.blurred(im, 3)
+    compare_images(first, lab.blurred(im, 3))
+    first['pixels'][0] = 0
+    compare_images(results.blurred(im, 3), lab.blurred(im, 3))
+    assert (results.stats['hits'], results.stats['misses']) == (1, 1)
+
+    kernel = {'height': 3, 'width': 3, 'pixels': [0, 0.5, 0, 0, 0.5, 0, 0, 0, 0]}
+    assert results.correlate(im, kernel, 'wrap') == lab.correlate(im, kernel, 'wrap')
+    assert results.correlate(im, kernel, 'zero') == lab.correlate(im, kernel, 'zero')
+    assert results.stats['misses'] == 3
+
+    # A fresh cache finds earlier results on disk
+    reopened = cache.ResultCache(directory=str(tmp_path))
+    compare_images(reopened.blurred(im, 3), lab.blurred(im, 3))
+    assert (reopened.stats['disk_hits'], reopened.stats['misses']) == (1, 0)
+
+    # A truncated file is a miss, and is replaced
+    key = cache.ResultCache.key('blurred', im, 5)
+    reopened.blurred(im, 5)
+    path = reopened._disk_path(key)
+    with open(path, 'r+b') as handle:
+        handle.truncate(os.path.getsize(path) // 2)
+    broken = cache.ResultCache(directory=str(tmp_path))
+    compare_images(broken.blurred(im, 5), lab.blurred(im, 5))
+    assert (broken.stats['disk_hits'], broken.stats['misses']) == (0, 1)
+    assert broken._disk_bytes == sum(os.path.getsize(name) for name in broken._disk_files())
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.partial')]
+    compare_images(cache.ResultCache(directory=str(tmp_path)).blurred(im, 5), lab.blurred(im, 5))
+
+
+def test_result_cache_eviction(tmp_path):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'pattern.png'))
+    size = im['height'] * im['width']
+    results = cache.ResultCache(max_bytes=2 * size, directory=str(tmp_path), max_disk_bytes=0)
+    for kernsize in (1, 3, 5):
+        results.blurred(im, kernsize)
+    assert results.stats['evictions'] == 1
+    assert results.stats['disk_evictions'] == 3
+    results.blurred(im, 5)
+    results.blurred(im, 1)
+    assert (results.stats['hits'], results.stats['misses']) == (1, 4)
+
+
+def test_bench_regressions():
+    results = bench.run(sizes=(8,), kernel_sizes=(3,), test_images=False, repeat=1,
+                        isolate=False, report=lambda line: None)
+    assert 'correlate[wrap,3] synthetic 8x8' in results
+    assert all(metrics['megapixels_per_second'] > 0 for metrics in results.values())
+    assert bench.regressions(results, results) == []
+
+    faster = {case: dict(metrics, megapixels_per_second=metrics['megapixels_per_second'] * 2)
+              for case, metrics in results.items()}
+    assert len(bench.regressions(results, faster, threshold=0.2)) == len(results)
+    assert bench.regressions(results, faster, threshold=0.6) == []
+
+    # The result is still held while the snapshots are taken
+    metrics = bench.measure('inverted', ('synthetic', 64, 64), [3], repeat=1)
+    assert metrics['retained_blocks'] >= 1 and metrics['retained_bytes'] >= 64 * 64
+
+
+def test_instrumentation(tmp_path):
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel.png')
+    outfile = str(tmp_path / 'out.png')
+    with lab.instrumentation(lab.MemorySink()) as sink:
+        im = lab.load_greyscale_image(inpfile)
+        kernel = {'height': 3, 'width': 3, 'pixels': [0, 0.5, 0, 0, 0, 0, 0, 0.5, 0]}
+        lab.round_and_clip_image(lab.correlate(im, kernel, 'extend'))
+        lab.save_greyscale_image(lab.blurred(im, 3), outfile)
+    pixels = im['height'] * im['width']
+    totals = sink.totals
+    assert totals['load']['bytes_read'] == os.path.getsize(inpfile)
+    assert totals['load']['pixels'] == pixels
+    assert totals['correlate']['kernel_taps'] == 9 * pixels
+    assert totals['round_and_clip']['calls'] >= 1
+    assert totals['blurred']['pixels'] == pixels
+    assert totals['save']['bytes_written'] == os.path.getsize(outfile)
+    assert all(seconds >= 0 for _, seconds, _ in sink.events)
+
+    # Nothing is recorded once the block exits
+    lab.inverted(im)
+    assert 'inverted' not in sink.totals
+
+    handle = io.StringIO()
+    with lab.instrumentation(lab.JsonLinesSink(handle)):
+        lab.inverted(im)
+    event = json.loads(handle.getvalue())
+    assert (event['stage'], event['pixels']) == ('inverted', pixels)
+
+
+def test_profile_sink():
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'pattern.png'))
+    with lab.instrumentation(lab.ProfileSink('edges')) as sink:
+        lab.inverted(im)
+        assert sink.stats is None
+        lab.edges(im)
+    assert sink.peak > 0
+    assert any(name == 'edges' for _, _, name in sink.stats.stats)
+
+    # A failed call stops profiling, and the next call is captured on its own
+    with lab.instrumentation(lab.ProfileSink('blurred')) as sink:
+        with pytest.raises(Exception):
+            lab.blurred(im, 0)
+        assert not tracemalloc.is_tracing() and sink.stats is None
+        lab.blurred(im, 3)
+    assert not tracemalloc.is_tracing()
+    assert not any(name == 'blurred' and calls > 1
+                   for (_, _, name), (calls, *_) in sink.stats.stats.items())
+
+
+def test_process_frames():
+    names = ['centered_pixel', 'pattern', 'blob']
+    images = [lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', name + '.png'))
+              for name in names]
+    frame_filter = frames.FrameFilter([('blur', 3), ('edges', None)], buffers=2)
+    first = frame_filter(images[1])
+    compare_images(first, lab.edges(lab.blurred(images[1], 3)))
+    second = frame_filter(images[1])
+    # Output buffers are reused in turn
+    assert frame_filter(images[1])['pixels'] is first['pixels']
+    assert second['pixels'] is not first['pixels']
+
+    results = frames.process_frames(images, [('sharpen', 5)])
+    for image, result in zip(images, results):
+        compare_images(result, lab.sharpened(image, 5))
+
+
+def test_frames_nested_names(tmp_path, capsys):
+    source = os.path.join(TEST_DIRECTORY, 'test_images', 'pattern.png')
+    for directory in ('a', 'b'):
+        os.makedirs(tmp_path / 'in' / directory)
+        with open(source, 'rb') as inp, open(tmp_path / 'in' / directory / 'f.png', 'wb') as out:
+            out.write(inp.read())
+    pattern = str(tmp_path / 'in' / '**' / '*.png')
+    assert frames.main([pattern, '--filter', 'invert', '--output', str(tmp_path / 'out')]) == 0
+    for directory in ('a', 'b'):
+        compare_images(lab.load_greyscale_image(str(tmp_path / 'out' / directory / 'f.png')),
+                       lab.inverted(lab.load_greyscale_image(source)))
+    (tmp_path / 'in' / 'a' / 'f.jpg').write_bytes(b'')
+    with pytest.raises(SystemExit):
+        frames.main([pattern, str(tmp_path / 'in' / 'a' / 'f.jpg'), '--filter', 'invert',
+                     '--output', str(tmp_path / 'out')])
+
+
+def test_decode_into():
+    buffer = bytearray(b'stale')
+    for name in ('pattern', 'cat', 'videoframe_479'):
+        filename = os.path.join(TEST_DIRECTORY, 'test_images', f'{name}.png')
+        frame = frames._decode_into(filename, buffer)
+        assert frame['pixels'] is buffer
+        compare_images(frame, lab.load_greyscale_image(filename))
+
+
+def test_process_sequence(tmp_path):
+    frame = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'pattern.png'))
+    inputs = []
+    for index in range(6):
+        inputs.append(str(tmp_path / f'frame_{index}.png'))
+        lab.save_greyscale_image(lab.blurred(frame, 2 * index + 1), inputs[-1])
+    outputs = [str(tmp_path / f'edges_{index}.png') for index in range(6)]
+    summary = frames.process_sequence(inputs, outputs, [('edges', None)], prefetch=2,
+                                      encode_ahead=1)
+    assert summary['frames'] == 6
+    for in_filename, out_filename in zip(inputs, outputs):
+        compare_images(lab.load_greyscale_image(out_filename),
+                       lab.edges(lab.load_greyscale_image(in_filename)))
+
+
+def test_filter_server(tmp_path):
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', 'pattern.png')
+    with open(inpfile, 'rb') as handle:
+        body = handle.read()
+    path = str(tmp_path / 'filters.sock')
+
+    async def scenario():
+        service = server.FilterServer(workers=1, max_pending=4, batch_delay=0.05)
+        await service.start(path=path)
+        try:
+            replies = await asyncio.gather(*(
+                loadgen.request('POST', '/filter?spec=blur:3', body, path=path)
+                for _ in range(4)))
+            load = await loadgen.run_load(body, 'invert', requests=12, concurrency=12, path=path)
+            bad = await loadgen.request('POST', '/filter?spec=emboss', body, path=path)
+            return replies, load, bad, service.stats()
+        finally:
+            await service.close()
+
+    replies, load, bad, stats = asyncio.run(scenario())
+    expected = lab.blurred(lab.load_greyscale_image(inpfile), 3)
+    for status, reply in replies:
+        assert status == 200
+        compare_images(lab.load_greyscale_image(io.BytesIO(reply)), expected)
+    # The four blur requests arrived together and ran as one batch
+    assert stats['batches'] < stats['batched_requests']
+    # Only four requests fit in the queue at once
+    assert load['statuses'][503] >= 8 and load['statuses'][200] >= 1
+    assert stats['rejected'] == load['statuses'][503]
+    assert bad[0] == 400
+    assert stats['latency_ms']['p50'] <= stats['latency_ms']['p99']
+
+
+def test_filter_server_errors(tmp_path):
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', 'pattern.png')
+    with open(inpfile, 'rb') as handle:
+        body = handle.read()
+    # One failing image does not fail the rest of its batch
+    results = server.filter_images([('invert', None)], [b'not an image', body])
+    assert [status for status, _ in results] == [400, 200]
+    assert server.filter_images([('blur', 'x')], [body])[0][0] == 500
+
+    path = str(tmp_path / 'filters.sock')
+
+    async def failing(stages, body):
+        raise RuntimeError("worker died")
+
+    async def scenario():
+        service = server.FilterServer(workers=1)
+        service.submit = failing
+        await service.start(path=path)
+        try:
+            reply = await loadgen.request('POST', '/filter?spec=invert', body, path=path)
+            for _ in range(3):
+                await loadgen.request('GET', '/stats', b'', path=path)
+            await loadgen.request('GET', '/missing', b'', path=path)
+            return reply, service.stats()
+        finally:
+            await service.close()
+
+    (status, reply), stats = asyncio.run(scenario())
+    assert status == 500 and b"worker died" in reply
+    assert stats['failed'] == 1
+
+
+@pytest.mark.parametrize("boundary", ['zero', 'wrap', 'extend'])
+def test_correlate_out(boundary):
+    im = bench.synthetic_image(40, 30)
+    for kernel in ({'height': 5, 'width': 5, 'pixels': [(i % 7) / 9 - 0.3 for i in range(25)]},
+                   {'height': 9, 'width': 3, 'pixels': [(i % 5) - 2 for i in range(27)]}):
+        expected = lab.correlate(im, kernel, boundary, method='direct')
+        out = lab.FloatImage(40, 30)
+        assert lab.correlate(im, kernel, boundary, out=out) is out
+        assert list(out['pixels']) == list(expected['pixels'])
+        # In place, with bands smaller than the kernel
+        source = lab.FloatImage.from_values(40, 30, im['pixels'])
+        source.pixels = lab.array('d', source.pixels)
+        lab.BAND_PIXELS, saved = 30, lab.BAND_PIXELS
+        try:
+            lab.correlate(source, kernel, boundary, method='direct', out=source)
+        finally:
+            lab.BAND_PIXELS = saved
+        assert list(source['pixels']) == list(expected['pixels'])
+
+
+def test_filters_out_in_place():
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'mushroom.png'))
+    pool = lab.ScratchPool()
+    for name, func in (('inverted', lambda image, out: lab.inverted(image, out=out)),
+                       ('blur 5', lambda image, out: lab.blurred(image, 5, out=out)),
+                       ('blur 4', lambda image, out: lab.blurred(image, 4, out=out)),
+                       ('sharpen 3', lambda image, out: lab.sharpened(image, 3, out=out)),
+                       ('edges', lambda image, out: lab.edges(image, out=out))):
+        expected = func(im, None)
+        out = pool.image(im['height'], im['width'])
+        assert func(im, out) is out
+        compare_images(out, expected)
+        copy = lab.GreyscaleImage(im['height'], im['width'], bytearray(im['pixels']))
+        compare_images(func(copy, copy), expected)
+    assert pool.image(im['height'], im['width']) is out
+    with pytest.raises(ValueError):
+        lab.edges(im, out=pool.image(3, 3))
+
+
+def test_out_variants_do_not_allocate_images():
+    # After warm-up, peak memory per call depends on the width and the
+    # kernel but not on the height: no full-size buffers are allocated
+    pool = lab.ScratchPool()
+    kernel = {'height': 5, 'width': 5, 'pixels': [(i % 7) - 3 for i in range(25)]}
+    calls = [lambda im: lab.inverted(im, out=pool.image(im['height'], im['width'])),
+             lambda im: lab.blurred(im, 3, out=pool.image(im['height'], im['width'])),
+             lambda im: lab.sharpened(im, 4, out=pool.image(im['height'], im['width'])),
+             lambda im: lab.edges(im, out=pool.image(im['height'], im['width'])),
+             lambda im: lab.correlate(im, kernel, 'extend', method='direct',
+                                      out=pool.image(im['height'], im['width'], 'q'))]
+    short, tall = bench.synthetic_image(32, 32), bench.synthetic_image(1024, 32)
+    for call in calls:
+        peaks = []
+        for im in (short, tall):
+            out = call(im)  # warm-up
+            tracemalloc.start()
+            call(im)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        assert peaks[1] < 1.5 * peaks[0] + 4096 < memoryview(out['pixels']).nbytes
+
+
+def test_edges_options():
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'mushroom.png'))
+    gy = lab.correlate(im, lab.SOBEL_KERNEL_FIRST, 'extend')['pixels']
+    gx = lab.correlate(im, lab.SOBEL_KERNEL_SECOND, 'extend')['pixels']
+    exact = [min(255, round(math.sqrt(x * x + y * y))) for x, y in zip(gx, gy)]
+
+    result, directions = lab.edges(im, direction=True)
+    assert list(result['pixels']) == exact
+    assert list(directions['pixels']) == [round(math.atan2(y, x) * 128 / math.pi) % 256
+                                          for x, y in zip(gx, gy)]
+    binary = lab.edges(im, threshold=100)
+    assert list(binary['pixels']) == [255 if value >= 100 else 0 for value in exact]
+    l1 = lab.edges(im, magnitude='l1')
+    assert list(l1['pixels']) == [min(255, abs(x) + abs(y)) for x, y in zip(gx, gy)]
+
+    assert lab.sqrt_table()[lab.SOBEL_MAX_SQUARE] == 255
+    assert all(lab.sqrt_table()[n] == round(math.sqrt(n)) for n in range(65281))
+
+
+def _edit(image, rect, value):
+    left, top, right, bottom = rect
+    for row in range(top, bottom):
+        for col in range(left, right):
+            lab.set_pixel(image, row, col, value)
+
+
+@pytest.mark.parametrize("name, kernsize", [('invert', None), ('blur', 5), ('blur', 4),
+                                            ('sharpen', 3), ('edges', None)])
+def test_recompute_regions(name, kernsize):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'chess.png'))
+    full = {'invert': lambda: lab.inverted(im), 'blur': lambda: lab.blurred(im, kernsize),
+            'sharpen': lambda: lab.sharpened(im, kernsize), 'edges': lambda: lab.edges(im)}[name]
+    previous = full()
+    dirty = [(0, 0, 3, 2), (50, 40, 70, 45), (im['width'] - 1, 100, im['width'], 130)]
+    for rect, value in zip(dirty, (0, 255, 17)):
+        _edit(im, rect, value)
+    assert lab.recompute_regions(im, previous, dirty, name, kernsize) is previous
+    compare_images(previous, full())
+
+
+@pytest.mark.parametrize("boundary", ['zero', 'wrap', 'extend'])
+def test_recorrelate_regions(boundary):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'pattern.png'))
+    kernel = {'height': 5, 'width': 5, 'pixels': [(i % 7) / 9 - 0.3 for i in range(25)]}
+    previous = lab.correlate(im, kernel, boundary, method='direct')
+    dirty = [(0, 0, 1, 1), (3, 4, 5, 6)]
+    for rect, value in zip(dirty, (255, 0)):
+        _edit(im, rect, value)
+    lab.recorrelate_regions(im, kernel, boundary, previous, dirty)
+    assert list(previous['pixels']) == list(lab.correlate(im, kernel, boundary, method='direct')['pixels'])
+
+
+def test_affected_regions():
+    assert lab.affected_regions([(10, 10, 12, 11)], 2, 100, 50) == [(8, 8, 14, 13)]
+    assert lab.affected_regions([(0, 0, 1, 1)], 2, 100, 50, 'zero') == [(0, 0, 3, 3)]
+    assert sorted(lab.affected_regions([(0, 0, 1, 1)], 2, 100, 50, 'wrap')) == [
+        (0, 0, 3, 3), (0, 98, 3, 100), (48, 0, 50, 3), (48, 98, 50, 100)]
+
+
+def test_pyramid_levels():
+    im = lab.GreyscaleImage(3, 5, bytearray([0, 10, 20, 30, 40,
+                                             1, 11, 21, 31, 41,
+                                             9, 99, 7, 77, 255]))
+    half = pyramid.downsample(im)
+    assert (half['height'], half['width']) == (2, 3)
+    assert list(half['pixels']) == [6, 26, 40, 54, 42, 255]
+    pyr = pyramid.Pyramid(im)
+    assert pyr.depth == 3
+    assert pyr.level(1) == half and pyr.level(1) is pyr.level(1)
+    assert (pyr.level(2)['height'], pyr.level(2)['width']) == (1, 2)
+    with pytest.raises(ValueError):
+        pyr.level(3)
+    big = pyramid.upsample(half, 3, 5)
+    assert list(big['pixels']) == [6, 6, 26, 26, 40, 6, 6, 26, 26, 40, 54, 54, 42, 42, 255]
+    # Level 2 pixels each cover 4x4 pixels of the image, though 5 / 2 rounds up to 3
+    low = [255 - pixel for pixel in pyr.level(2)['pixels']]
+    assert list(pyr.preview('invert', level=2)['pixels']) == [low[0]] * 4 + [low[1]] + (
+        [low[0]] * 4 + [low[1]]) * 2
+    assert [pyramid.scaled_kernel_size(size, 2) for size in (1, 7, 15, 31)] == [1, 1, 3, 7]
+    assert [pyramid.scaled_kernel_size(size, 0) for size in (1, 2, 4, 7)] == [1, 2, 4, 7]
+
+
+def test_pyramid_even_kernel():
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'mushroom.png'))
+    pyr = pyramid.Pyramid(im)
+    assert pyr.filtered('blur', 4, 0) == lab.blurred(im, 4)
+    preview = pyr.preview('blur', 4, 1)
+    assert pyr.error('blur', 4, 1) == pyramid.image_error(preview, lab.blurred(im, 4))
+
+
+@pytest.mark.parametrize("name, kernsize", [('invert', None), ('blur', 15), ('sharpen', 9),
+                                            ('edges', None)])
+def test_pyramid_preview(name, kernsize):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'cat.png'))
+    pyr = pyramid.Pyramid(im)
+    assert pyr.preview(name, kernsize, 0) == pyr.filtered(name, kernsize, 0)
+    assert pyr.error(name, kernsize, 0) == {'mean_absolute': 0, 'max_absolute': 0,
+                                            'psnr': math.inf}
+    preview = pyr.preview(name, kernsize, 2)
+    assert (preview['height'], preview['width']) == (im['height'], im['width'])
+    error = pyr.error(name, kernsize, 1)
+    assert 0 < error['mean_absolute'] <= error['max_absolute'] <= 255
+    if name != 'edges':
+        assert error['psnr'] > 20
+
+
+def test_raw_image_roundtrip(tmp_path):
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'cat.png'))
+    kernel = {'height': 3, 'width': 3, 'pixels': [0.1] * 9}
+    for image, typecode in [(im, 'B'), (lab.correlate(im, lab.generate_kernel(3, 1), 'zero'), 'q'),
+                            (lab.correlate(im, kernel, 'extend'), 'd'),
+                            ({'height': 1, 'width': 3, 'pixels': [0.5, -2, 300]}, 'd')]:
+        lab.save_raw_image(image, tmp_path / 'image.raw')
+        mapped = lab.open_raw_image(tmp_path / 'image.raw')
+        assert mapped['pixels'].format == typecode
+        assert mapped == image
+        with pytest.raises(TypeError):
+            mapped['pixels'][0] = 1
+    assert os.listdir(tmp_path) == ['image.raw']
+
+    lab.save_raw_image(im, tmp_path / 'image.raw')
+    mapped = lab.open_raw_image(tmp_path / 'image.raw')
+    for filt in (lab.inverted, lambda i: lab.blurred(i, 5), lambda i: lab.sharpened(i, 4),
+                 lab.edges, lambda i: lab.correlate(i, kernel, 'wrap')):
+        assert filt(mapped) == filt(im)
+    lab.save_raw_image(lab.correlate(im, kernel, 'extend'), tmp_path / 'float.raw')
+    float_mapped = lab.open_raw_image(tmp_path / 'float.raw')
+    assert lab.blurred(float_mapped, 3) == lab.blurred(lab.correlate(im, kernel, 'extend'), 3)
+
+    out = lab.create_raw_image(tmp_path / 'out.raw', im['height'], im['width'])
+    assert lab.blurred(mapped, 3, out=out) is out
+    assert lab.open_raw_image(tmp_path / 'out.raw') == lab.blurred(im, 3)
+    lab.edges(out, out=out)
+    assert lab.open_raw_image(tmp_path / 'out.raw') == lab.edges(lab.blurred(im, 3))
+
+    # Filters that store lists of values write into mapped targets too
+    height, width = im['height'], im['width']
+    integer = {'height': 3, 'width': 3, 'pixels': [1, -2, 0, 3, 1, 0, 0, 2, -1]}
+    wide = lab.create_raw_image(tmp_path / 'wide.raw', height, width, 'q')
+    lab.correlate(im, integer, 'extend', method='direct', out=wide)
+    assert lab.open_raw_image(tmp_path / 'wide.raw') == lab.correlate(im, integer, 'extend')
+    lab.median_filtered(im, 3, out=lab.create_raw_image(tmp_path / 'median.raw', height, width))
+    assert lab.open_raw_image(tmp_path / 'median.raw') == lab.median_filtered(im, 3)
+
+
+def test_raw_image_errors(tmp_path):
+    (tmp_path / 'bad.raw').write_bytes(b'not an image')
+    with pytest.raises(ValueError):
+        lab.open_raw_image(tmp_path / 'bad.raw')
+    lab.save_raw_image(lab.GreyscaleImage(4, 4), tmp_path / 'short.raw')
+    with open(tmp_path / 'short.raw', 'r+b') as handle:
+        handle.truncate(40)
+    with pytest.raises(ValueError):
+        lab.open_raw_image(tmp_path / 'short.raw')
+    with pytest.raises(ValueError):
+        lab.create_raw_image(tmp_path / 'x.raw', 2, 2, 'f')
+    lab.save_raw_image(lab.GreyscaleImage(0, 5), tmp_path / 'empty.raw')
+    assert lab.open_raw_image(tmp_path / 'empty.raw') == lab.GreyscaleImage(0, 5)
+
+
+@pytest.mark.parametrize("kernsize", [1, 2, 3, 4, 5])
+@pytest.mark.parametrize("boundary", ['zero', 'wrap', 'extend'])
+def test_rank_filters(kernsize, boundary):
+    im = bench.synthetic_image(9, 13)
+    im['pixels'][::7] = bytes(len(im['pixels'][::7]))
+    last = kernsize ** 2 - 1
+    for rank in sorted({0, last // 3, kernsize ** 2 // 2, last}):
+        expected = bench.naive_rank_filtered(im, kernsize, rank, boundary)
+        methods = ['sort', 'histogram', 'auto'] + (['separable'] if rank in (0, last) else [])
+        for method in methods:
+            assert lab.rank_filtered(im, kernsize, rank, boundary, method) == expected
+    assert lab.median_filtered(im, kernsize, boundary) == bench.naive_rank_filtered(
+        im, kernsize, kernsize ** 2 // 2, boundary)
+    assert lab.min_filtered(im, kernsize, boundary) == bench.naive_rank_filtered(
+        im, kernsize, 0, boundary)
+    assert lab.max_filtered(im, kernsize, boundary) == bench.naive_rank_filtered(
+        im, kernsize, last, boundary)
+    assert lab.percentile_filtered(im, kernsize, 100, boundary) == lab.max_filtered(
+        im, kernsize, boundary)
+
+
+def test_rank_filter_unknown_boundary():
+    im = bench.synthetic_image(9, 13)
+    assert lab.rank_filtered(im, 3, 4, 'mirror') is None
+    assert lab.median_filtered(im, 3, 'mirror') is None
+    assert lab.correlate(im, lab.generate_kernel(3, 1), 'mirror') is None
+
+
+def test_bench_naive_opt_in():
+    ops = bench.operations([3, 9])
+    assert not [name for name in ops if 'naive' in name]
+    assert 'median[sort,3]' in ops and 'median[sort,9]' not in ops
+    assert 'median[histogram,9]' in ops
+    ops = bench.operations([3, 9], naive=True)
+    assert {'median[naive,9]', 'median[sort,9]'} <= set(ops)
+
+
+def test_median_removes_salt_and_pepper():
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'cat.png'))
+    noisy = lab.GreyscaleImage(im['height'], im['width'], bytearray(im['pixels']))
+    noisy['pixels'][::37] = b'\xff' * len(noisy['pixels'][::37])
+    noisy['pixels'][11::41] = bytes(len(noisy['pixels'][11::41]))
+    result = lab.median_filtered(noisy, 7)
+    assert result == lab.median_filtered(noisy, 7, method='sort')
+    assert 255 not in result['pixels'][::37] and 0 not in result['pixels'][11::41]
+    expected = lab.median_filtered(noisy, 3)
+    assert lab.median_filtered(noisy, 3, out=noisy) is noisy
+    assert noisy == expected
+    streamed = b''.join(lab.filter_rows(lab._image_rows(im), im['height'], im['width'],
+                                        'median', 5))
+    assert streamed == lab.median_filtered(im, 5)['pixels']
+    assert batch.apply_stages(im, batch.parse_filter_spec('median:3')) == lab.median_filtered(im, 3)
+    with pytest.raises(ValueError):
+        lab.rank_filtered(im, 3, 9)
+    with pytest.raises(ValueError):
+        lab.rank_filtered(im, 3, 4, method='separable')
+
+
+def test_color_image(tmp_path):
+    from PIL import Image
+    rgb = Image.open(os.path.join(TEST_DIRECTORY, 'test_images', 'mario.png')).convert('RGB')
+    rgba = rgb.copy()
+    rgba.putalpha(Image.linear_gradient('L').resize(rgb.size))
+    rgb.save(str(tmp_path / 'rgb.png'))
+    rgba.save(str(tmp_path / 'rgba.png'))
+
+    color = lab.load_color_image(str(tmp_path / 'rgb.png'))
+    assert color['mode'] == 'RGB'
+    assert [plane['pixels'] for plane in color['planes']] == [band.tobytes() for band in rgb.split()]
+    kernel = lab.generate_kernel(3, 1 / 9)
+    for filt in (lab.inverted, lambda i: lab.blurred(i, 3), lambda i: lab.sharpened(i, 3),
+                 lab.edges, lambda i: lab.correlate(i, kernel, 'wrap'),
+                 lambda i: lab.median_filtered(i, 3)):
+        result = filt(color)
+        assert result['planes'] == [filt(plane) for plane in color['planes']]
+    assert color.map(lab.blurred, 3, processes=2) == lab.blurred(color, 3)
+
+    translucent = lab.load_color_image(str(tmp_path / 'rgba.png'), box=(0, 0, 20, 10))
+    assert translucent['mode'] == 'RGBA'
+    alpha = bytes(translucent['planes'][3]['pixels'])
+    result = lab.inverted(translucent)
+    assert result['planes'][3]['pixels'] == alpha
+    assert result['planes'][0] == lab.inverted(translucent['planes'][0])
+    assert lab.inverted(translucent, alpha=True)['planes'][3] == lab.inverted(translucent['planes'][3])
+    expected = lab.blurred(translucent, 5)
+    assert lab.blurred(translucent, 5, out=translucent) is translucent
+    assert translucent == expected
+
+    # Edge directions come back as a second colour image
+    magnitudes, directions = lab.edges(translucent, direction=True)
+    pairs = [lab.edges(plane, direction=True) for plane in translucent['planes'][:3]]
+    assert magnitudes['planes'][:3] == [pair[0] for pair in pairs]
+    assert directions['planes'][:3] == [pair[1] for pair in pairs]
+    assert magnitudes['planes'][3] == directions['planes'][3] == translucent['planes'][3]
+    assert magnitudes['planes'][3] is not directions['planes'][3]
+    assert translucent.map(lab.edges, direction=True, processes=2) == (magnitudes, directions)
+
+    lab.save_color_image(lab.correlate(color, kernel, 'extend'), str(tmp_path / 'out.png'))
+    assert lab.load_color_image(str(tmp_path / 'out.png')) == lab.round_and_clip_image(
+        lab.correlate(color, kernel, 'extend'))
+    out = io.BytesIO()
+    lab.save_color_image(expected, out)
+    out.seek(0)
+    assert lab.load_color_image(out) == expected
+
+
+def test_kernel_plan():
+    assert len(lab.kernel_plan(lab.generate_kernel(5, 1))['terms']) == 1
+    assert len(lab.kernel_plan(lab.SOBEL_KERNEL_FIRST)['terms']) == 1
+    plan = lab.kernel_plan(lab.sharpen_kernel(4))
+    assert len(plan['terms']) == 2 and all(isinstance(value, int) for column, row in plan['terms']
+                                           for value in column + row)
+    rebuilt = [sum(column[row_index] * row[col] for column, row in plan['terms']) / plan['scale']
+               for row_index in range(4) for col in range(4)]
+    assert rebuilt == lab.sharpen_kernel(4)['pixels']
+    assert lab.kernel_plan({'height': 3, 'width': 3, 'pixels': [1, -2, 0, 3, 1, 0, 0, 2, -1]}) is None
+    assert lab.kernel_plan({'height': 2, 'width': 2, 'pixels': [0, 0, 0, 0]}) is None
+    box = lab.generate_kernel(7, 1 / 49)
+    assert lab.kernel_plan(box) is lab.kernel_plan(lab.generate_kernel(7, 1 / 49))
+    assert lab.kernel_plan(box) is not lab.kernel_plan(lab.generate_kernel(7, 1))
+
+
+@pytest.mark.parametrize("boundary", ['zero', 'wrap', 'extend'])
+def test_low_rank_correlate_matches_dense(boundary):
+    weights = [math.exp(-(x - 3) ** 2 / 4) for x in range(7)]
+    gaussian = {'height': 7, 'width': 7, 'pixels': [a * b for a in weights for b in weights]}
+    total = sum(gaussian['pixels'])
+    gaussian['pixels'] = [value / total for value in gaussian['pixels']]
+    unsharp = lab.generate_kernel(6, -1 / 36)
+    unsharp['pixels'][21] += 2
+    two_terms = {'height': 5, 'width': 5, 'pixels': [(r * c % 3) / 7 - (r == 2) * (c + 1) / 5
+                                                     for r in range(5) for c in range(5)]}
+    for name in ('cat', 'pattern', 'centered_pixel'):
+        im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', f'{name}.png'))
+        for kernel in (gaussian, unsharp, two_terms, lab.sharpen_kernel(4), lab.SOBEL_KERNEL_SECOND):
+            assert lab.kernel_plan(kernel) is not None
+            expected = lab.correlate(im, kernel, boundary, method='direct')
+            result = lab.correlate(im, kernel, boundary, method='separable')
+            if all(isinstance(value, int) for value in kernel['pixels']):
+                assert result == expected
+            assert lab.round_and_clip_image(result) == lab.round_and_clip_image(expected)
+
+
+def test_separable_float_pixels():
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'cat.png'))
+    floats = lab.FloatImage(im['height'], im['width'], array(
+        'd', [pixel + (i % 7) / 4 for i, pixel in enumerate(im['pixels'])]))
+    for size in (4, 6):
+        kernel = lab.sharpen_kernel(size)
+        expected = lab.correlate(floats, kernel, 'extend', method='direct')
+        result = lab.correlate(floats, kernel, 'extend', method='separable')
+        assert all(abs(a - b) < 1e-6 for a, b in zip(result['pixels'], expected['pixels']))
+        dense = lab.round_and_clip_image(lab.FloatImage(im['height'], im['width'], array(
+            'd', [total / size ** 2 for total in expected['pixels']])))
+        assert lab.sharpened(floats, size) == dense
+        assert lab.round_and_clip_image(result) == lab.round_and_clip_image(expected)
+
+
+def test_edges_wide_and_float_pixels(tmp_path):
+    assert list(lab.edges({'height': 1, 'width': 4, 'pixels': [300, 600, 900, 1200]})['pixels']) == [255] * 4
+    assert list(lab.edges({'height': 1, 'width': 4, 'pixels': [0, 1000, 0, 5000]}, threshold=1,
+                          magnitude='l1')['pixels']) == [255, 0, 255, 255]
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'cat.png'))
+    floats = lab.correlate(im, lab.generate_kernel(3, 1 / 9), 'extend')
+    x_gradients = lab.correlate(floats, lab.SOBEL_KERNEL_FIRST, 'extend', method='direct')['pixels']
+    y_gradients = lab.correlate(floats, lab.SOBEL_KERNEL_SECOND, 'extend', method='direct')['pixels']
+    expected = [min(255, round(math.sqrt(x * x + y * y))) for x, y in zip(x_gradients, y_gradients)]
+    assert list(lab.edges(floats)['pixels']) == expected
+    lab.save_raw_image(floats, tmp_path / 'floats.raw')
+    assert list(lab.edges(lab.open_raw_image(tmp_path / 'floats.raw'))['pixels']) == expected